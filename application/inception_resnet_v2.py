@@ -33,6 +33,6 @@ def InceptionResNetV2(input_shape=[299, 299, 3], n_classes=150):
     x = keras.layers.GlobalAveragePooling2D()(x)
     x = keras.layers.Dropout(0.8)(x)
 
-    output = keras.layers.Dense(n_classes, activation='softmax')(x)
+    output = keras.layers.Dense(n_classes, activation='softmax', dtype='float32')(x)
 
     return keras.models.Model(inputs=[img_input], outputs=[output])
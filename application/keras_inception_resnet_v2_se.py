@@ -40,6 +40,6 @@ def KerasInceptionResNetV2SEBlock(input_shape=[299, 299, 3], n_classes=150, sque
     x = conv2d_bn(x, channel, '1x1', 's', 1)
 
     x = keras.layers.GlobalAveragePooling2D()(x)
-    output = keras.layers.Dense(n_classes, activation='softmax')(x)
+    output = keras.layers.Dense(n_classes, activation='softmax', dtype='float32')(x)
 
     return keras.models.Model(inputs=[img_input], outputs=[output])
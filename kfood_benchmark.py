@@ -0,0 +1,342 @@
+import os
+import time
+import json
+import argparse
+import itertools
+import subprocess
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+
+import kfood_dataset
+
+FIXTURE_PATH = 'kfood_fixture'
+N_THREADS = (1, 2, 4, tf.data.AUTOTUNE)
+BATCH_SIZES = (16, 32, 64)
+MODEL_NAMES = ('KerasInceptionResNetV2', 'KerasInceptionResNetV2SEBlock', 'InceptionResNetV2', 'SmallKerasInceptionResNetV2')
+PRECISIONS = ('float32', 'mixed_bfloat16')
+
+
+def make_fixture_dataset(fixture_path=FIXTURE_PATH, n_classes=4, n_images=64, image_size=(480, 640), seed=0):
+    #kfood 와 같은 구조의 작은 합성 데이터셋 : fixture_path/fixture/<클래스>/Fixture_xxx_xxxx.(jpg|png) + crop_area.properties
+    #이미지 이름이 실제 kfood 의 Img_xxx_xxxx 와 겹치지 않게 한다, 크롭은 get_fixture_crop_table 로 넘긴다
+    rng = np.random.default_rng(seed)
+    CLASSES = kfood_dataset.get_class_index()[1]
+    for label in range(n_classes):
+        class_dir = Path(fixture_path) / 'fixture' / CLASSES[label]
+        os.makedirs(class_dir, exist_ok=True)
+        rows = []
+        for i in range(n_images):
+            name = 'Fixture_{:03d}_{:04d}'.format(label, i)
+            #노이즈만 있는 이미지는 JPEG 압축이 안되므로 그라디언트를 섞는다
+            gradient = np.linspace(0, 255, image_size[1], dtype=np.float32)[None, :, None]
+            noise = rng.normal(0, 20, size=(*image_size, 3))
+            image = np.clip(gradient + noise + label * 30, 0, 255).astype(np.uint8)
+            if i % 4 == 0:
+                encoded = tf.io.encode_png(image)
+                filename = name + '.png'
+            else:
+                encoded = tf.io.encode_jpeg(image, quality=90)
+                filename = name + '.jpg'
+            tf.io.write_file(str(class_dir / filename), encoded)
+            if i % 2 == 0:
+                #x, y, w, h
+                x, y = int(rng.integers(0, image_size[1] // 4)), int(rng.integers(0, image_size[0] // 4))
+                rows.append('{}={},{},{},{}'.format(name, x, y, image_size[1] // 2, image_size[0] // 2))
+        with open(class_dir / 'crop_area.properties', 'w') as f:
+            f.write('\n'.join(rows) + '\n')
+    print('fixture ready :', fixture_path)
+    return fixture_path
+
+
+def get_fixture_crop_table(fixture_path=FIXTURE_PATH):
+    crop_points = {}
+    for class_dir in Path(fixture_path).glob('*/*'):
+        if (class_dir / 'crop_area.properties').exists():
+            crop_points.update(kfood_dataset.get_image_crop_points(class_dir))
+    return kfood_dataset.CropPointTable(crop_points)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def time_iterator(iterator, n_steps, images_per_step):
+    #첫 원소는 그래프 생성, 버퍼 채우기 시간이 포함되므로 제외한다
+    next(iterator)
+    latencies = []
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for _ in range(n_steps):
+        step_start = time.perf_counter()
+        next(iterator)
+        latencies.append(time.perf_counter() - step_start)
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    latencies = np.array(latencies) * 1000
+    return {
+        'seconds': seconds,
+        'images_per_sec': n_steps * images_per_step / seconds,
+        'latency_ms_mean': float(latencies.mean()),
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        #1.0 = 모든 코어 사용
+        'cpu_utilization': cpu_seconds / seconds / os.cpu_count(),
+    }
+
+
+def time_dataset(dataset, n_batches, batch_size):
+    return time_iterator(iter(dataset), n_batches, batch_size)
+
+
+def cached_input(dataset):
+    #이전 단계 결과를 메모리에 올려 두고 측정할 단계만 실행한다
+    dataset = dataset.cache()
+    for _ in dataset:
+        pass
+    return dataset.repeat()
+
+
+def benchmark_stages(filepaths, crop_table, n_threads=N_THREADS, batch_sizes=BATCH_SIZES, n_steps=200):
+    results = []
+    def record(stage, threads, batch_size, result):
+        result.update({'stage': stage, 'n_threads': 'AUTOTUNE' if threads == tf.data.AUTOTUNE else threads, 'batch_size': batch_size})
+        results.append(result)
+        print('{:>16} threads={:>8} batch={:>4} : {:10.1f} images/sec, p50 {:.2f} ms, cpu {:.0%}'.format(
+            stage, str(result['n_threads']), str(batch_size), result['images_per_sec'], result['latency_ms_p50'], result['cpu_utilization']))
+
+    #list : 경로 검색은 파이썬에서 한번만 실행된다
+    dataset_path = str(Path(filepaths[0]).parent.parent.parent)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    kfood_dataset.get_image_paths(dataset_path, shuffle=False)
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    record('list', 1, None, {'seconds': seconds, 'images_per_sec': len(filepaths) / seconds,
+                             'latency_ms_mean': seconds * 1000, 'latency_ms_p50': seconds * 1000,
+                             'latency_ms_p95': seconds * 1000, 'cpu_utilization': cpu_seconds / seconds / os.cpu_count()})
+
+    names = [Path(filepath).name.split('.')[0] for filepath in filepaths]
+    paths = tf.data.Dataset.from_tensor_slices(filepaths)
+    contents = cached_input(paths.map(tf.io.read_file))
+    decoded = cached_input(paths.map(lambda filepath: tf.image.decode_image(tf.io.read_file(filepath), channels=3, expand_animations=False)))
+    named = cached_input(tf.data.Dataset.zip((decoded, tf.data.Dataset.from_tensor_slices(names))))
+    cropped = cached_input(named.map(crop_table.crop))
+    squared = cached_input(cropped.map(kfood_dataset.central_crop))
+    resized = cached_input(squared.map(kfood_dataset.resize_and_rescale))
+
+    stages = {
+        'read': (paths.repeat(), tf.io.read_file),
+        'decode': (contents, lambda image: tf.image.decode_image(image, channels=3, expand_animations=False)),
+        'properties_crop': (named, crop_table.crop),
+        'random_crop': (cropped, kfood_dataset.random_crop),
+        'central_crop': (cropped, kfood_dataset.central_crop),
+        'resize': (squared, kfood_dataset.resize_and_rescale),
+    }
+    for stage, (dataset, map_fn) in stages.items():
+        for threads in n_threads:
+            record(stage, threads, None, time_iterator(iter(dataset.map(map_fn, num_parallel_calls=threads)), n_steps, 1))
+
+    for batch_size in batch_sizes:
+        record('batch', None, batch_size, time_dataset(resized.batch(batch_size), max(n_steps // batch_size, 10), batch_size))
+
+    for threads in n_threads:
+        for batch_size in batch_sizes:
+            dataset = kfood_dataset.make_kfood_dataset(
+                filepaths, batch_size=batch_size,
+                pipeline_config=kfood_dataset.PipelineConfig(n_parse_threads=threads),
+                properties_crop=crop_table,
+            )
+            record('pipeline', threads, batch_size, time_dataset(dataset, max(n_steps // batch_size, 10), batch_size))
+    return results
+
+
+def benchmark_fused_crop(filepaths, crop_table=True, n_batches=50, batch_size=32, randomize=True, n_parse_threads=tf.data.AUTOTUNE):
+    results = []
+    for name, fused_crop in (('decode_then_crop', False), ('fused_crop', True)):
+        dataset = kfood_dataset.make_kfood_dataset(
+            filepaths,
+            n_parse_threads=n_parse_threads,
+            batch_size=batch_size,
+            randomize=randomize,
+            fused_crop=fused_crop,
+            properties_crop=crop_table,
+        )
+        result = time_dataset(dataset, n_batches, batch_size)
+        result.update({'stage': name, 'n_threads': 'AUTOTUNE' if n_parse_threads == tf.data.AUTOTUNE else n_parse_threads, 'batch_size': batch_size})
+        results.append(result)
+        print('{} : {:.1f} images/sec'.format(name, result['images_per_sec']))
+    print('speedup : {:.2f}x'.format(results[1]['images_per_sec'] / results[0]['images_per_sec']))
+    return results
+
+
+def benchmark_batch_augment(filepaths, crop_table=True, n_batches=50, batch_size=32, randomize=True, n_parse_threads=tf.data.AUTOTUNE):
+    results = []
+    for name, batch_augment in (('element_augment', False), ('batch_augment', True)):
+        dataset = kfood_dataset.make_kfood_dataset(
+            filepaths,
+            n_parse_threads=n_parse_threads,
+            batch_size=batch_size,
+            randomize=randomize,
+            batch_augment=batch_augment,
+            properties_crop=crop_table,
+        )
+        result = time_dataset(dataset, n_batches, batch_size)
+        result.update({'stage': name, 'n_threads': 'AUTOTUNE' if n_parse_threads == tf.data.AUTOTUNE else n_parse_threads, 'batch_size': batch_size})
+        results.append(result)
+        print('{} : {:.1f} images/sec'.format(name, result['images_per_sec']))
+    print('speedup : {:.2f}x'.format(results[1]['images_per_sec'] / results[0]['images_per_sec']))
+    return results
+
+
+def benchmark_precision(model_names=MODEL_NAMES, precisions=PRECISIONS, batch_size=32, n_steps=20, train_set=None, valid_set=None, steps_per_epoch=100, validation_steps=20, epochs=1):
+    #모델, precision 별 훈련 step 시간 (합성 배치), train_set 이 있으면 epochs 만큼 훈련한 정확도도 기록한다
+    from train import build_model
+    keras = tf.keras
+    rng = np.random.default_rng(0)
+    images = tf.constant(rng.uniform(-1, 1, size=(batch_size, *kfood_dataset.IMAGE_SIZE, 3)), dtype=tf.float32)
+    labels = tf.one_hot(rng.integers(0, 150, size=batch_size), 150)
+
+    results = []
+    for model_name in model_names:
+        for precision in precisions:
+            keras.backend.clear_session()
+            model = build_model(model_name, [*kfood_dataset.IMAGE_SIZE, 3], precision)
+            optimizer = keras.optimizers.SGD(learning_rate=0.01, momentum=0.9)
+            if precision == 'mixed_float16':
+                optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
+            model.compile(loss='categorical_crossentropy', optimizer=optimizer, metrics=['accuracy'])
+
+            #time_iterator 의 한 step = 훈련 한 step
+            steps = (model.train_on_batch(images, labels) for _ in itertools.count())
+            result = time_iterator(steps, n_steps, batch_size)
+            result.update({'stage': '{}/{}'.format(model_name, precision), 'n_threads': None, 'batch_size': batch_size,
+                           'step_ms': result['seconds'] / n_steps * 1000})
+            if train_set is not None:
+                history = model.fit(train_set, steps_per_epoch=steps_per_epoch, epochs=epochs,
+                                    validation_data=valid_set, validation_steps=validation_steps, verbose=0)
+                result['accuracy'] = history.history['accuracy'][-1]
+                if valid_set is not None:
+                    result['val_accuracy'] = history.history['val_accuracy'][-1]
+            results.append(result)
+            print('{:>30} {:>14} : {:8.1f} ms/step, {:6.1f} images/sec{}'.format(
+                model_name, precision, result['step_ms'], result['images_per_sec'],
+                ', val_accuracy {:.3f}'.format(result['val_accuracy']) if 'val_accuracy' in result else ''))
+    return results
+
+
+def benchmark_jit(model_names=MODEL_NAMES, batch_size=32, n_steps=20):
+    #모델별 XLA on/off : 첫 step (그래프 생성 + 컴파일) 시간과 이후 step 시간, 훈련과 추론 각각
+    from train import build_model
+    keras = tf.keras
+    rng = np.random.default_rng(0)
+    images = tf.constant(rng.uniform(-1, 1, size=(batch_size, *kfood_dataset.IMAGE_SIZE, 3)), dtype=tf.float32)
+    labels = tf.one_hot(rng.integers(0, 150, size=batch_size), 150)
+
+    results = []
+    for model_name in model_names:
+        for jit_compile in (False, True):
+            keras.backend.clear_session()
+            model = build_model(model_name, [*kfood_dataset.IMAGE_SIZE, 3])
+            model.compile(loss='categorical_crossentropy', optimizer=keras.optimizers.SGD(learning_rate=0.01, momentum=0.9), jit_compile=jit_compile)
+            inference = tf.function(lambda x: model(x, training=False), jit_compile=jit_compile)
+
+            for mode, step in (('train', lambda: model.train_on_batch(images, labels)),
+                               ('inference', lambda: inference(images).numpy())):
+                start = time.perf_counter()
+                step()
+                first_step = time.perf_counter() - start
+                result = time_iterator((step() for _ in itertools.count()), n_steps, batch_size)
+                result.update({'stage': '{}/{}/{}'.format(model_name, mode, 'xla' if jit_compile else 'graph'), 'n_threads': None, 'batch_size': batch_size,
+                               'first_step_ms': first_step * 1000, 'step_ms': result['seconds'] / n_steps * 1000})
+                results.append(result)
+                print('{:>30} {:>9} {:>5} : first step {:9.1f} ms, step {:8.1f} ms, {:6.1f} images/sec'.format(
+                    model_name, mode, 'xla' if jit_compile else 'graph', result['first_step_ms'], result['step_ms'], result['images_per_sec']))
+
+    #XLA 가 첫 step 에 더 쓰는 시간을 몇 step 만에 되찾는지
+    for model_name in model_names:
+        for mode in ('train', 'inference'):
+            graph, xla = [next(r for r in results if r['stage'] == '{}/{}/{}'.format(model_name, mode, name)) for name in ('graph', 'xla')]
+            saved = graph['step_ms'] - xla['step_ms']
+            overhead = xla['first_step_ms'] - graph['first_step_ms']
+            print('{:>30} {:>9} : xla speedup {:.2f}x, break-even {}'.format(
+                model_name, mode, graph['step_ms'] / xla['step_ms'],
+                '{:.0f} steps'.format(max(overhead, 0) / saved) if saved > 0 else 'never'))
+    return results
+
+
+def compare_results(base_path, new_path):
+    #같은 (stage, n_threads, batch_size) 끼리 images/sec 비교
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    base_results = {(r['stage'], str(r['n_threads']), str(r['batch_size'])): r for r in base['results']}
+    print('{} -> {}'.format(base['commit'], new['commit']))
+    for r in new['results']:
+        key = (r['stage'], str(r['n_threads']), str(r['batch_size']))
+        if key in base_results:
+            ratio = r['images_per_sec'] / base_results[key]['images_per_sec']
+            print('{:>16} threads={:>8} batch={:>4} : {:10.1f} -> {:10.1f} images/sec ({:.2f}x)'.format(
+                key[0], key[1], key[2], base_results[key]['images_per_sec'], r['images_per_sec'], ratio))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=['stages', 'fused_crop', 'batch_augment', 'precision', 'jit', 'compare'])
+    parser.add_argument('result_paths', nargs='*', metavar='BASE NEW', help='compare : 비교할 두 --output 결과')
+    parser.add_argument('--dataset-path', default=None, help='없으면 합성 fixture 데이터셋을 만든다')
+    parser.add_argument('--n-steps', type=int, default=200)
+    parser.add_argument('--n-batches', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--central', action='store_true')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--models', nargs='+', default=MODEL_NAMES)
+    parser.add_argument('--precisions', nargs='+', default=PRECISIONS)
+    parser.add_argument('--epochs', type=int, default=0, help='precision : 0 이면 step 시간만 측정한다')
+    args = parser.parse_args()
+    if args.benchmark == 'compare' and len(args.result_paths) != 2:
+        parser.error('compare needs two result files : compare BASE NEW')
+    if args.benchmark != 'compare' and args.result_paths:
+        parser.error('result files are only used by compare')
+
+    if args.benchmark == 'compare':
+        compare_results(*args.result_paths)
+    else:
+        dataset_path = args.dataset_path
+        if dataset_path is None:
+            dataset_path = make_fixture_dataset()
+        paths = kfood_dataset.get_image_paths(dataset_path)
+        #전역 kfood 테이블 대신 측정하는 데이터셋의 crop_area.properties 를 쓴다
+        crop_table = get_fixture_crop_table(dataset_path)
+
+        if args.benchmark == 'stages':
+            results = benchmark_stages(paths, crop_table, n_steps=args.n_steps)
+        elif args.benchmark == 'fused_crop':
+            results = benchmark_fused_crop(paths, crop_table, args.n_batches, args.batch_size, randomize=not args.central)
+        elif args.benchmark == 'batch_augment':
+            results = benchmark_batch_augment(paths, crop_table, args.n_batches, args.batch_size, randomize=not args.central)
+        elif args.benchmark == 'jit':
+            results = benchmark_jit(args.models, args.batch_size, args.n_steps)
+        elif args.benchmark == 'precision':
+            train_set = valid_set = None
+            if args.epochs:
+                train_paths, valid_paths, _ = kfood_dataset.split_image_paths(paths)
+                train_set = kfood_dataset.make_kfood_dataset(train_paths, batch_size=args.batch_size, properties_crop=crop_table)
+                valid_set = kfood_dataset.make_kfood_dataset(valid_paths, batch_size=args.batch_size, randomize=False, properties_crop=crop_table)
+            results = benchmark_precision(args.models, args.precisions, args.batch_size, args.n_steps, train_set, valid_set,
+                                          steps_per_epoch=args.n_batches, epochs=args.epochs)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump({
+                    'commit': get_commit(),
+                    'tensorflow': tf.__version__,
+                    'cpu_count': os.cpu_count(),
+                    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'dataset_path': dataset_path,
+                    'results': results,
+                }, f, indent=2)
@@ -1,22 +1,27 @@
-from curses import echo
-from random import shuffle
 import tensorflow as tf
 import numpy as np
 import os
+import hashlib
 from pathlib import Path
-import matplotlib.pyplot as plt
 from glob import glob
 
-from torch import exp2
-
 IMAGE_SIZE = (299, 299)
 BATCH_SIZE = 32
+#짧은 변 최대 길이, random crop(90%) 후에도 299 이상이 남도록
+BOUNDED_SIZE = 384
+#batch_augment 에서 배치로 묶기 전 크기
+INTERMEDIATE_SIZE = (384, 384)
+#cache 뒤에서 섞는 버퍼 크기 (BOUNDED_SIZE uint8 이미지 약 440KB, 1024 개면 약 450MB)
+CACHE_SHUFFLE_SIZE = 1024
+#sampler 에서 클래스 안의 경로를 섞는 버퍼 크기 (클래스 수 만큼 버퍼가 생긴다)
+CLASS_SHUFFLE_SIZE = 64
 
 #데이터셋
 DATASET_NAME = 'kfood'
 DRIVE_PATH = Path(os.getcwd())
 DATASET_PATH = DRIVE_PATH / DATASET_NAME
 filepath = DATASET_PATH
+CROP_POINTS_CACHE_PATH = DRIVE_PATH / 'kfood_crop_points.npz'
 print('dataset path :', DATASET_PATH ,filepath.exists())
 
 def make_class_to_label_file():
@@ -28,30 +33,52 @@ def make_class_to_label_file():
             f.write(str(label) + ',' + class_name + '\n')
 
 
-if not os.path.exists(DRIVE_PATH / 'class_to_label.txt'):
-    print('making class to label txt file...')
-    make_class_to_label_file()
-
-
-print('saving classes, labels...')
-#class_label 매칭 딕셔너리로 저장
-LABELS = []
-CLASSES = []
-with open('class_to_label.txt','r', encoding='utf8') as f:
-    for line in f.readlines():
-        _label, _class = line.strip().split(',')
-        LABELS.append(int(_label))
-        CLASSES.append(_class)
-#print(len(classes), len(labels), classes, labels)
-#class_to_label = {}
-#for _class, _label in zip(classes, labels):
-#    class_to_label[_class] = int(_label)
-LABELS = np.array(LABELS)
-CLASSES = np.array(CLASSES)
-if len(LABELS) == len(CLASSES):
-    n_labels = len(LABELS)
-
-
+#LABELS, CLASSES, n_labels, crop_points, crop_point_table 는 처음 사용할 때 만든다
+_class_index = None
+_crop_points = None
+_crop_point_table = None
+
+def get_class_index():
+    global _class_index
+    if _class_index is not None:
+        return _class_index
+
+    if not os.path.exists(DRIVE_PATH / 'class_to_label.txt'):
+        print('making class to label txt file...')
+        make_class_to_label_file()
+
+    print('saving classes, labels...')
+    #class_label 매칭 딕셔너리로 저장
+    labels = []
+    classes = []
+    with open('class_to_label.txt','r', encoding='utf8') as f:
+        for line in f.readlines():
+            _label, _class = line.strip().split(',')
+            labels.append(int(_label))
+            classes.append(_class)
+    _class_index = (np.array(labels), np.array(classes))
+    return _class_index
+
+
+def __getattr__(name):
+    if name == 'LABELS':
+        return get_class_index()[0]
+    if name == 'CLASSES':
+        return get_class_index()[1]
+    if name == 'n_labels':
+        return len(get_class_index()[0])
+    if name == 'crop_points':
+        return get_crop_points()
+    if name == 'crop_point_table':
+        return get_crop_point_table()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def get_labels(filepaths):
+    #경로의 클래스 디렉토리 이름 -> 레이블, 클래스 당 한번의 dict 조회
+    LABELS, CLASSES = get_class_index()
+    class_to_label = dict(zip(CLASSES.tolist(), LABELS.tolist()))
+    return np.array([class_to_label[filepath.split('/')[-2]] for filepath in filepaths], dtype=np.int32)
 
 
 def get_image_crop_points(filepath):
@@ -73,26 +100,109 @@ def get_image_crop_points(filepath):
     return crops
 
 
-print('saving crop information...')
-#crop 지점 정보 빼오기
-crop_points = {}
-class_list = list(filepath.glob("*/*"))
-class_list = [class_name for class_name in class_list if class_name.is_dir()]
-for class_name in class_list:
-    crop_points.update(get_image_crop_points(class_name))
-
-tf_crop_image_names = tf.constant(list(crop_points.keys()), dtype=tf.string)
-tf_crop_points = tf.constant(list(crop_points.values()))
-
-print('ready!')
-
-def get_image_paths(dataset_path='kfood', image_formats=('png', 'jpg', 'jpeg'), shuffle=True):
+def get_crop_sources(dataset_path=DATASET_PATH):
+    #클래스 디렉토리와 crop_area.properties 의 수정 시간, 캐시 무효화에 사용한다
+    class_list = [class_name for class_name in Path(dataset_path).glob("*/*") if class_name.is_dir()]
+    sources = sorted(str(class_name) for class_name in class_list)
+    mtimes = []
+    for source in sources:
+        properties = Path(source) / "crop_area.properties"
+        mtimes.append(max(os.stat(source).st_mtime, os.stat(properties).st_mtime if properties.exists() else 0.))
+    return np.array(sources, dtype=str), np.array(mtimes, dtype=np.float64)
+
+
+def build_crop_points(dataset_path=DATASET_PATH, cache_path=CROP_POINTS_CACHE_PATH):
+    print('saving crop information...')
+    sources, mtimes = get_crop_sources(dataset_path)
+    #crop 지점 정보 빼오기
+    crop_points = {}
+    for source in sources:
+        if (Path(source) / "crop_area.properties").exists():
+            crop_points.update(get_image_crop_points(Path(source)))
+
+    names = np.array(list(crop_points.keys()), dtype=str)
+    points = np.array(list(crop_points.values()), dtype=np.int32).reshape(-1, 4)
+    np.savez(cache_path, names=names, points=points, sources=sources, mtimes=mtimes)
+    return crop_points
+
+
+def load_crop_points(dataset_path=DATASET_PATH, cache_path=CROP_POINTS_CACHE_PATH):
+    if not os.path.exists(cache_path):
+        return None
+    sources, mtimes = get_crop_sources(dataset_path)
+    with np.load(cache_path) as cache:
+        if not (np.array_equal(cache['sources'], sources) and np.array_equal(cache['mtimes'], mtimes)):
+            return None
+        return dict(zip(cache['names'].tolist(), cache['points'].tolist()))
+
+
+def get_crop_points():
+    global _crop_points
+    if _crop_points is None:
+        _crop_points = load_crop_points()
+        if _crop_points is None:
+            _crop_points = build_crop_points()
+    return _crop_points
+
+
+#crop 정보가 없는 이미지
+NO_CROP = (-1, -1, -1, -1)
+
+class CropPointTable():
+    def __init__(self, crop_points):
+        names = list(crop_points.keys())
+        points = np.array(list(crop_points.values()), dtype=np.int32).reshape(-1, 4)
+        #이미지 이름 -> points 의 행 번호, 없으면 마지막 행(NO_CROP)
+        self.table = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(
+                tf.constant(names, dtype=tf.string),
+                tf.range(len(names), dtype=tf.int64),
+            ),
+            default_value=len(names),
+        )
+        self.points = tf.constant(np.concatenate([points, [NO_CROP]]), dtype=tf.int32)
+        #make_kfood_dataset 의 디스크 캐시 이름에 쓴다
+        self.key = get_cache_name(names, points)
+
+    def lookup(self, image_name):
+        #(offset_height, offset_width, target_height, target_width), 없으면 NO_CROP
+        return tf.gather(self.points, self.table.lookup(image_name))
+
+    def crop(self, image, image_name):
+        crop_offsets = self.lookup(image_name)
+        if crop_offsets[0] >= 0:
+            image = tf.image.crop_to_bounding_box(image, crop_offsets[0], crop_offsets[1], crop_offsets[2], crop_offsets[3])
+        return image
+
+
+def get_crop_point_table():
+    global _crop_point_table
+    if _crop_point_table is None:
+        #dataset.map 안에서 처음 불려도 테이블은 eager 로 만든다
+        with tf.init_scope():
+            _crop_point_table = CropPointTable(get_crop_points())
+        print('ready!')
+    return _crop_point_table
+
+def get_properties_crop_table(properties_crop):
+    #properties_crop : True 면 DATASET_PATH 의 전체 테이블, CropPointTable 이면 그 테이블 (kfood_benchmark 의 fixture), False 면 None
+    if properties_crop is True:
+        return get_crop_point_table()
+    return properties_crop or None
+
+
+def get_image_paths(dataset_path='kfood', image_formats=('png', 'jpg', 'jpeg'), shuffle=True, use_manifest=False):
     print('finding image paths...')
-    #데이터셋의 이미지 경로 및 레이블 저장
-    image_paths = sorted(glob(dataset_path + "/*/*/*"))
+    if use_manifest:
+        #kfood_manifest.npz 에서 읽고, 바뀐 클래스 디렉토리만 다시 스캔한다
+        from kfood_manifest import get_manifest, filter_manifest
+        lower_format_image_paths = filter_manifest(get_manifest(dataset_path), image_formats)['paths'].tolist()
+    else:
+        #데이터셋의 이미지 경로 및 레이블 저장
+        image_paths = sorted(glob(dataset_path + "/*/*/*"))
 
-    lower_format_image_paths = []
-    lower_format_image_paths = [image_path for image_path in image_paths if image_path.split('.')[-1].lower() in image_formats]
+        lower_format_image_paths = []
+        lower_format_image_paths = [image_path for image_path in image_paths if image_path.split('.')[-1].lower() in image_formats]
     
 
     if shuffle:
@@ -104,8 +214,18 @@ def get_image_paths(dataset_path='kfood', image_formats=('png', 'jpg', 'jpeg'),
     return lower_format_image_paths
 
 
+def split_image_paths(image_paths, test_size=0.2, valid_size=0.1):
+    # train : 0.7, test : 0.2, valid : 0.1
+    n_test = int(len(image_paths) * test_size)
+    n_valid = int(len(image_paths) * valid_size)
+    test_paths = image_paths[:n_test]
+    valid_paths = image_paths[n_test:n_test + n_valid]
+    train_paths = image_paths[n_test + n_valid:]
+    return train_paths, valid_paths, test_paths
+
+
 
-def parse_and_crop_image(tf_filepath, label):
+def parse_and_crop_image(tf_filepath, label, properties_crop=True):
     
     image = tf.io.read_file(tf_filepath) # 이미지 파일 읽기
     filepath = tf.compat.path_to_str(tf_filepath)
@@ -121,12 +241,11 @@ def parse_and_crop_image(tf_filepath, label):
     
     #crop
     image_name = tf.strings.split(tf.strings.split(filepath, "/")[-1], ".")[0]
-    tf_image_idx = tf.where(tf_crop_image_names == image_name)
     
-    #crop 정보가 있으면 크롭
-    if tf.reduce_all(tf.not_equal(tf.shape(tf_image_idx), tf.constant((0, 1), dtype=tf.int32))):
-        crop_offsets = tf_crop_points[tf.reshape(tf_image_idx, shape=())]
-        image = tf.image.crop_to_bounding_box(image, crop_offsets[0], crop_offsets[1], crop_offsets[2], crop_offsets[3])
+    #crop 정보가 있으면 크롭, properties_crop=False 는 이미 크롭된 데이터셋 (kfood_transcode)
+    crop_table = get_properties_crop_table(properties_crop)
+    if crop_table is not None:
+        image = crop_table.crop(image, image_name)
 
     return image, label
 
@@ -140,14 +259,44 @@ def central_crop(image):
     return image[top_crop : bottom_crop, left_crop : right_crop]
 
 
-def resizing_image(image, label, randomize):
+def resizing_image(image, label, randomize, image_size=IMAGE_SIZE):
     if randomize:
         image = random_crop(image)
     else:
         image = central_crop(image)
-    image = tf.image.resize(image, IMAGE_SIZE, method="nearest")
-    image = tf.cast(image, tf.float32) / 255.
-    return image , label
+    return resize_and_rescale(image, image_size), label
+
+
+def resize_and_rescale(image, image_size=IMAGE_SIZE):
+    image = tf.image.resize(image, image_size, method="nearest")
+    return tf.cast(image, tf.float32) / 255.
+
+
+def resize_to_intermediate(image, label):
+    #배치로 묶기 위해 고정 크기로 resize, 원본 크기는 crop 영역 계산에 쓴다
+    shape = tf.shape(image)[:2]
+    image = tf.image.resize(image, INTERMEDIATE_SIZE, method="nearest")
+    return image, shape, label
+
+
+def get_crop_boxes(shapes, randomize):
+    #shapes : batch x 2 원본 (height, width) -> crop_and_resize 의 정규화된 (y1, x1, y2, x2)
+    #random_crop, central_crop 와 같은 원본 기준 정사각형 영역
+    shapes = tf.cast(shapes, tf.float32)
+    min_dim = tf.reduce_min(shapes, axis=1, keepdims=True)
+    if randomize:
+        crop_size = tf.floor(min_dim * 0.9)
+        offsets = tf.floor(tf.random.uniform(tf.shape(shapes)) * (shapes - crop_size + 1))
+    else:
+        crop_size = min_dim
+        offsets = tf.floor((shapes - crop_size) / 2)
+    return tf.concat([offsets / shapes, (offsets + crop_size) / shapes], axis=1)
+
+
+def batch_resizing_image(images, shapes, labels, randomize, image_size=IMAGE_SIZE):
+    boxes = get_crop_boxes(shapes, randomize)
+    images = tf.image.crop_and_resize(images, boxes, tf.range(tf.shape(images)[0]), image_size, method="nearest")
+    return images / 255., labels
 
 
 def random_crop(image):
@@ -156,48 +305,261 @@ def random_crop(image):
     return tf.image.random_crop(image, [min_dim, min_dim, 3])
 
 
-def make_kfood_dataset(filepaths, shuffle_buffer_size=None, n_parse_threads=5, batch_size=32, randomize=True ,cache=False):
+def bounded_resize(image, max_size=BOUNDED_SIZE):
+    shape = tf.shape(image)
+    min_dim = tf.reduce_min([shape[0], shape[1]])
+    #작은 이미지는 그대로 두고 큰 이미지만 줄인다
+    if min_dim > max_size:
+        scale = max_size / tf.cast(min_dim, tf.float32)
+        new_size = tf.cast(tf.cast(shape[:2], tf.float32) * scale, tf.int32)
+        image = tf.image.resize(image, new_size, method='area')
+        image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+    return image
+
+
+def get_crop_window(image_shape, crop_offsets, randomize):
+    #crop_area.properties 크롭 안에서 random/central crop 한 최종 영역 (offset_height, offset_width, height, width)
+    full_image = tf.stack([0, 0, image_shape[0], image_shape[1]])
+    box = tf.where(crop_offsets[0] >= 0, crop_offsets, full_image)
+    min_dim = tf.minimum(box[2], box[3])
+    if randomize:
+        crop_size = tf.maximum(min_dim * 90 // 100, 1)
+        offset_height = box[0] + tf.random.uniform((), 0, box[2] - crop_size + 1, dtype=tf.int32)
+        offset_width = box[1] + tf.random.uniform((), 0, box[3] - crop_size + 1, dtype=tf.int32)
+    else:
+        crop_size = min_dim
+        offset_height = box[0] + (box[2] - crop_size) // 2
+        offset_width = box[1] + (box[3] - crop_size) // 2
+    return tf.stack([offset_height, offset_width, crop_size, crop_size])
 
-    filenames_dataset = tf.data.Dataset.from_tensor_slices(filepaths)
-    labels = [LABELS[np.where(CLASSES == filepath.split('/')[-2])[0][0]] for filepath in filepaths]
-    labels = tf.one_hot(labels, n_labels, dtype=tf.uint8)
-    labels_dataset = tf.data.Dataset.from_tensor_slices(labels)
-    
-    dataset = tf.data.Dataset.zip((filenames_dataset, labels_dataset))
-    
-    dataset = dataset.repeat()
-    dataset = dataset.shuffle(len(filepaths))
 
-    dataset = dataset.map(parse_and_crop_image, num_parallel_calls=n_parse_threads)
-    dataset = dataset.map(lambda image, label : resizing_image(image, label, randomize), num_parallel_calls=n_parse_threads)
+def parse_and_crop_window(tf_filepath, label, randomize, properties_crop=True):
+    #JPEG 는 최종 crop 영역만 디코딩, 나머지 형식은 parse_and_crop_image 와 같다
+    contents = tf.io.read_file(tf_filepath)
+    filepath = tf.compat.path_to_str(tf_filepath)
+    image_name = tf.strings.split(tf.strings.split(filepath, "/")[-1], ".")[0]
+    crop_table = get_properties_crop_table(properties_crop)
+    if crop_table is not None:
+        crop_offsets = crop_table.lookup(image_name)
+    else:
+        crop_offsets = tf.constant(NO_CROP, dtype=tf.int32)
+
+    if tf.io.is_jpeg(contents):
+        crop_window = get_crop_window(tf.image.extract_jpeg_shape(contents), crop_offsets, randomize)
+        image = tf.io.decode_and_crop_jpeg(contents, crop_window, channels=3, dct_method='INTEGER_FAST')
+    else:
+        image = tf.image.decode_image(contents, channels=3, expand_animations=False)
+        if crop_table is not None:
+            image = crop_table.crop(image, image_name)
+        if randomize:
+            image = random_crop(image)
+        else:
+            image = central_crop(image)
+    return image, label
+
+
+def get_class_weights(labels, sampler='uniform'):
+    #sampler : 'uniform' 클래스마다 같은 확률, 'natural' 클래스 크기에 비례, 'inverse' 클래스 크기에 반비례, 또는 클래스별 가중치 리스트
+    counts = np.bincount(labels, minlength=len(get_class_index()[0])).astype(np.float64)
+    if sampler == 'uniform':
+        weights = (counts > 0).astype(np.float64)
+    elif sampler == 'natural':
+        weights = counts
+    elif sampler == 'inverse':
+        weights = np.divide(1., counts, out=np.zeros_like(counts), where=counts > 0)
+    else:
+        weights = np.array(sampler, dtype=np.float64) * (counts > 0)
+    return weights / weights.sum()
+
+
+def make_class_balanced_dataset(filepaths, labels, sampler='uniform', shuffle_size=CLASS_SHUFFLE_SIZE):
+    #클래스마다 경로 데이터셋을 따로 만들어 클래스 안에서만 섞고, 가중치로 섞어서 뽑는다
+    #경로 순서는 한번 섞어두고, 에폭마다는 shuffle_size 버퍼로만 섞는다 (클래스 전체를 버퍼에 두지 않는다)
+    filepaths = np.asarray(filepaths)
+    weights = get_class_weights(labels, sampler)
+    class_datasets = []
+    class_weights = []
+    for label in np.flatnonzero(weights > 0):
+        class_filepaths = np.random.permutation(filepaths[labels == label])
+        class_dataset = tf.data.Dataset.from_tensor_slices((class_filepaths, labels[labels == label]))
+        class_datasets.append(class_dataset.shuffle(shuffle_size).repeat())
+        class_weights.append(weights[label])
+    return tf.data.experimental.sample_from_datasets(class_datasets, weights=class_weights)
+
+
+class PipelineConfig():
+    def __init__(self, n_parse_threads=tf.data.AUTOTUNE, fused_map=True, deterministic=False, private_threadpool_size=None, prefetch=tf.data.AUTOTUNE, ram_budget=None):
+        #n_parse_threads : map 병렬 수, fused_map : 디코딩과 전처리를 하나의 map 으로 합친다
+        #private_threadpool_size : 파이프라인 전용 스레드 수, ram_budget : AUTOTUNE 메모리 한도(bytes)
+        self.n_parse_threads = n_parse_threads
+        self.fused_map = fused_map
+        self.deterministic = deterministic
+        self.private_threadpool_size = private_threadpool_size
+        self.prefetch = prefetch
+        self.ram_budget = ram_budget
+
+    def apply(self, dataset):
+        options = tf.data.Options()
+        options.deterministic = self.deterministic
+        if self.private_threadpool_size:
+            options.threading.private_threadpool_size = self.private_threadpool_size
+        if self.ram_budget:
+            options.autotune.ram_budget = self.ram_budget
+        return dataset.with_options(options)
+
+    def __repr__(self):
+        def show(value):
+            return 'AUTOTUNE' if value == tf.data.AUTOTUNE else value
+        return 'PipelineConfig(n_parse_threads={}, fused_map={}, deterministic={}, private_threadpool_size={}, prefetch={}, ram_budget={})'.format(
+            show(self.n_parse_threads), self.fused_map, self.deterministic,
+            self.private_threadpool_size, show(self.prefetch), self.ram_budget,
+        )
+
+
+def get_cache_name(*parts):
+    #입력 경로, 크기, 크롭 설정이 바뀌면 다른 캐시 파일을 쓴다 (이전 split 의 캐시를 읽지 않도록)
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, (list, tuple)):
+            digest.update('\n'.join(str(item) for item in part).encode('utf8'))
+        else:
+            digest.update(str(part).encode('utf8'))
+        digest.update(b'\0')
+    return 'kfood_' + digest.hexdigest()[:16]
+
+
+def make_kfood_dataset(filepaths, shuffle_buffer_size=None, n_parse_threads=5, batch_size=32, randomize=True ,cache=False, source='files', sparse_labels=False, fused_crop=False, cache_size=BOUNDED_SIZE, pipeline_config=None, batch_augment=False, sampler=None, properties_crop=True, image_size=IMAGE_SIZE, teacher_logits=None):
+    #cache : True 면 메모리, 경로 문자열이면 디스크에 디코딩 + crop_area.properties 크롭된 uint8 이미지를 캐시한다
+    #디스크 캐시 파일 이름은 입력 경로, cache_size, properties_crop 의 해시 (get_cache_name)
+    #random crop, resize, 정규화는 캐시 뒤에서 매 에폭 새로 한다
+    #캐시 뒤에서 shuffle_buffer_size (없으면 CACHE_SHUFFLE_SIZE) 로 섞는다
+    #batch_augment : INTERMEDIATE_SIZE 로 resize 후 배치로 묶고, crop, resize, 정규화는 배치 단위로 한다
+    #sampler : 전체 셔플 대신 클래스별 데이터셋을 가중치로 섞는다 (get_class_weights 참고)
+    #properties_crop : False 면 crop_area.properties 크롭을 하지 않는다 (kfood_transcode 로 이미 크롭된 데이터셋)
+    #                  CropPointTable 을 넘기면 전체 kfood 테이블 대신 그 테이블로 크롭한다
+    #image_size : 최종 resize 크기, train 의 image_size_schedule 에서 단계마다 바꾼다
+    #teacher_logits : filepaths 순서의 teacher log 확률 (kfood_teacher.get_teacher_logits), 레이블은 [one-hot, teacher logits] 로 붙인다
+    if sampler and cache:
+        raise ValueError('sampler can not be used with cache')
+    if sampler and source in ('shards', 'memmap'):
+        raise ValueError('sampler needs filepaths or a manifest, not {}'.format(source))
+    if batch_augment and not batch_size:
+        raise ValueError('batch_augment needs batch_size (crop and resize run on batches)')
+    if teacher_logits is not None and (sampler or sparse_labels or source not in ('files', 'manifest')):
+        raise ValueError('teacher_logits needs one-hot labels from files or manifest without sampler')
+
+    #pipeline_config 가 없으면 이전과 같은 설정 (map 2번, 순서 고정, prefetch 1)
+    if pipeline_config is None:
+        pipeline_config = PipelineConfig(n_parse_threads=n_parse_threads, fused_map=False, deterministic=True, prefetch=1)
+    print('pipeline :', pipeline_config)
+    n_parse_threads = pipeline_config.n_parse_threads
+
+    if batch_augment:
+        fused_crop = False
+        augment = resize_to_intermediate
+    elif fused_crop and not cache and source not in ('shards', 'memmap'):
+        augment = lambda image, label : (resize_and_rescale(image, image_size), label)
+    else:
+        augment = lambda image, label : resizing_image(image, label, randomize, image_size)
+    augmented = False
+
+    n_labels = len(get_class_index()[0])
+    if source in ('shards', 'memmap'):
+        if source == 'shards':
+            #filepaths : kfood_shards.write_kfood_shards 로 만든 샤드 경로들 또는 샤드 디렉토리
+            from kfood_shards import read_kfood_shards, get_shard_paths
+            dataset = read_kfood_shards(filepaths, n_parse_threads, repeat=not cache)
+            cache_key = get_shard_paths(filepaths) if isinstance(filepaths, (str, Path)) else list(filepaths)
+        else:
+            #filepaths : kfood_store.load_image_store 로 읽은 memmap 이미지 저장소
+            from kfood_store import read_image_store
+            dataset = read_image_store(filepaths, n_parse_threads, repeat=not cache)
+            images = filepaths['images']
+            cache_key = [getattr(images, 'filename', None), getattr(images, 'offset', None), images.shape, filepaths['labels']]
+        if sparse_labels:
+            dataset = dataset.map(lambda image, label: (image, tf.cast(label, tf.int32)), num_parallel_calls=n_parse_threads)
+        else:
+            dataset = dataset.map(lambda image, label: (image, tf.one_hot(label, n_labels, dtype=tf.uint8)), num_parallel_calls=n_parse_threads)
+    else:
+        if source == 'manifest':
+            #filepaths : kfood_manifest.get_manifest 의 manifest (또는 select_manifest 로 나눈 일부)
+            labels = filepaths['labels'].astype(np.int32)
+            filepaths = filepaths['paths']
+        else:
+            labels = get_labels(filepaths)
+        cache_key = [list(filepaths), teacher_logits if teacher_logits is not None else '']
+        if sampler:
+            dataset = make_class_balanced_dataset(filepaths, labels, sampler)
+        else:
+            if teacher_logits is not None:
+                dataset = tf.data.Dataset.from_tensor_slices((filepaths, (labels, teacher_logits)))
+            else:
+                dataset = tf.data.Dataset.from_tensor_slices((filepaths, labels))
+            if not cache:
+                dataset = dataset.repeat()
+            dataset = dataset.shuffle(len(filepaths))
+
+        #sparse_labels 이면 정수 레이블 그대로, 아니면 one-hot 은 원소 단위로 만든다
+        if teacher_logits is not None:
+            dataset = dataset.map(lambda filepath, label: (filepath, tf.concat([tf.one_hot(label[0], n_labels, dtype=label[1].dtype), label[1]], 0)))
+        elif not sparse_labels:
+            dataset = dataset.map(lambda filepath, label: (filepath, tf.one_hot(label, n_labels, dtype=tf.uint8)))
+
+        #random crop 영역을 디코딩 전에 정하므로 캐시와 같이 쓸 수 없다
+        if fused_crop and not cache:
+            parse = lambda filepath, label: parse_and_crop_window(filepath, label, randomize, properties_crop)
+        else:
+            parse = lambda filepath, label: parse_and_crop_image(filepath, label, properties_crop)
+
+        if pipeline_config.fused_map and not cache:
+            dataset = dataset.map(lambda filepath, label: augment(*parse(filepath, label)), num_parallel_calls=n_parse_threads)
+            augmented = True
+        else:
+            dataset = dataset.map(parse, num_parallel_calls=n_parse_threads)
+
+    if cache:
+        dataset = dataset.map(lambda image, label: (bounded_resize(image, cache_size), label), num_parallel_calls=n_parse_threads)
+        if cache is True:
+            dataset = dataset.cache()
+        else:
+            os.makedirs(cache, exist_ok=True)
+            cache_name = get_cache_name(*cache_key, source, cache_size, getattr(properties_crop, 'key', properties_crop), sparse_labels)
+            dataset = dataset.cache(os.path.join(cache, cache_name))
+        dataset = dataset.repeat()
+        #캐시는 첫 에폭의 순서를 그대로 재생하므로 uint8 상태에서 매 에폭 다시 섞는다
+        dataset = dataset.shuffle(shuffle_buffer_size or CACHE_SHUFFLE_SIZE)
+
+    if not augmented:
+        dataset = dataset.map(augment, num_parallel_calls=n_parse_threads)
     #dataset = filenames_dataset.map(spa)
     
 
-    if cache:
-        dataset = dataset.cache()
-    if shuffle_buffer_size:
+    if shuffle_buffer_size and not cache:
         dataset = dataset.shuffle(shuffle_buffer_size)
     if batch_size:
         dataset = dataset.batch(batch_size)
-    return dataset.prefetch(1)
+    if batch_augment:
+        dataset = dataset.map(lambda images, shapes, labels: batch_resizing_image(images, shapes, labels, randomize, image_size), num_parallel_calls=n_parse_threads)
+    dataset = dataset.prefetch(pipeline_config.prefetch)
+    return pipeline_config.apply(dataset)
 
 
 def plot_dataset_image_4(dataset):
+    import matplotlib.pyplot as plt
+    CLASSES = get_class_index()[1]
     for images, labels in dataset.take(1):
         plt.figure(figsize=(16,8))
         plt.axis("off")
         for i in range(4):
             plt.subplot(1, 4, i+1)
             plt.imshow(images[i])
-            print(CLASSES[tf.where(labels[i] == 1)[0][0]], end=' ')
+            label = labels[i] if labels.shape.rank == 1 else tf.argmax(labels[i])
+            print(CLASSES[label], end=' ')
 
 def dataset_valid_check(paths):
-    from tqdm import tqdm
-    excepted_images = []
-    for i, path in tqdm(enumerate(paths)):
-        try:
-            byte_image = tf.io.read_file(path)
-            image = tf.image.decode_image(byte_image, channels=3, expand_animations=False)
-        except:
-            excepted_images.append(i)
-    return excepted_images
\ No newline at end of file
+    #kfood_validate.validate_dataset 으로 병렬 검사, 이전 검사 결과는 kfood_validation.json 에서 재사용한다
+    from kfood_validate import validate_dataset
+    quarantine = validate_dataset(paths)
+    return [i for i, path in enumerate(paths) if path in quarantine]
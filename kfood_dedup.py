@@ -0,0 +1,157 @@
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+
+import kfood_dataset
+
+HASH_INDEX_PATH = kfood_dataset.DRIVE_PATH / 'kfood_hashes.npz'
+HASH_RADIUS = 4
+#0 ~ 255 의 1 비트 수
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def image_hash(tf_filepath):
+    #dHash : crop_area.properties 크롭 후 9x8 흑백으로 줄여 가로로 이웃한 픽셀의 대소를 64 비트로
+    image, _ = kfood_dataset.parse_and_crop_image(tf_filepath, 0)
+    gray = tf.image.rgb_to_grayscale(image)
+    small = tf.image.resize(gray, (8, 9), method='area')[..., 0]
+    return tf.reshape(small[:, 1:] > small[:, :-1], [64])
+
+
+def pack_hashes(bits):
+    return np.packbits(bits.astype(np.uint8), axis=1).view('>u8').astype(np.uint64).reshape(-1)
+
+
+def popcount(x):
+    return POPCOUNT[np.ascontiguousarray(x, dtype=np.uint64).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def build_hash_index(manifest, index_path=HASH_INDEX_PATH, n_parse_threads=tf.data.AUTOTUNE):
+    #manifest : kfood_manifest.get_manifest, 이전 인덱스에서 경로, 크기, crop_area.properties 크롭이 같은 이미지는 다시 계산하지 않는다
+    #해시는 크롭 후에 계산하므로 크롭이 바뀌면 다시 계산한다
+    paths, sizes, crops = manifest['paths'], manifest['sizes'], manifest['crops']
+    keys = [(path, size, tuple(crop)) for path, size, crop in zip(paths, sizes, crops.tolist())]
+    hashes = np.zeros(len(paths), dtype=np.uint64)
+    valid = np.zeros(len(paths), dtype=bool)
+    reused = np.zeros(len(paths), dtype=bool)
+
+    old = load_hash_index(index_path)
+    #crops 가 없는 이전 형식의 인덱스는 다시 계산한다
+    if old is not None and 'crops' in old:
+        old_rows = {(path, size, tuple(crop)): i for i, (path, size, crop) in enumerate(zip(old['paths'], old['sizes'], old['crops'].tolist()))}
+        for i, key in enumerate(keys):
+            if key in old_rows:
+                hashes[i] = old['hashes'][old_rows[key]]
+                valid[i] = old['valid'][old_rows[key]]
+                reused[i] = True
+
+    todo = np.flatnonzero(~reused)
+    print('hashing {} / {} images...'.format(len(todo), len(paths)))
+    dataset = tf.data.Dataset.from_tensor_slices((todo, paths[todo]))
+    dataset = dataset.map(lambda i, filepath: (i, image_hash(filepath)), num_parallel_calls=n_parse_threads)
+    #디코딩 할 수 없는 이미지는 valid=False 로 남는다
+    dataset = dataset.apply(tf.data.experimental.ignore_errors())
+    for i, bits in dataset.batch(1024).as_numpy_iterator():
+        hashes[i] = pack_hashes(bits)
+        valid[i] = True
+
+    index = {'paths': paths, 'sizes': sizes, 'crops': crops, 'labels': manifest['labels'], 'hashes': hashes, 'valid': valid}
+    np.savez(index_path, **index)
+    print('hash index ready!')
+    return index
+
+
+def load_hash_index(index_path=HASH_INDEX_PATH):
+    if not os.path.exists(index_path):
+        return None
+    with np.load(index_path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def query_hash_index(index, image_hash, radius=HASH_RADIUS):
+    #해밍 거리 radius 이하인 이미지 인덱스, 거리 순
+    distances = popcount(index['hashes'] ^ np.uint64(image_hash))
+    found = np.flatnonzero((distances <= radius) & index['valid'])
+    return found[np.argsort(distances[found], kind='stable')]
+
+
+def find_duplicate_pairs(hashes, radius=HASH_RADIUS):
+    #multi-index hashing : 64 비트를 radius+1 조각으로 나누면 거리 radius 이하인 쌍은 적어도 한 조각이 같다
+    bits = np.unpackbits(hashes.astype('>u8').view(np.uint8).reshape(-1, 8), axis=1)
+    n_chunks = radius + 1
+    bounds = np.linspace(0, 64, n_chunks + 1).astype(int)
+    pairs = set()
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        keys = np.packbits(bits[:, start:end], axis=1)
+        keys = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.shape[1]))).reshape(-1)
+        _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        order = np.argsort(inverse, kind='stable')
+        group_starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        for group_start, count in zip(group_starts[counts > 1], counts[counts > 1]):
+            members = order[group_start:group_start + count]
+            for j, member in enumerate(members[:-1]):
+                others = members[j + 1:]
+                close = others[popcount(hashes[others] ^ hashes[member]) <= radius]
+                pairs.update((int(member), int(other)) for other in close)
+    return pairs
+
+
+def find_duplicate_clusters(index, radius=HASH_RADIUS):
+    #union-find, 반환값은 이미지마다 클러스터 번호 (invalid 이미지는 자기 자신만의 클러스터)
+    valid = np.flatnonzero(index['valid'])
+    parent = np.arange(len(index['hashes']))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for a, b in find_duplicate_pairs(index['hashes'][valid], radius):
+        root_a, root_b = find(valid[a]), find(valid[b])
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+    clusters = np.array([find(i) for i in range(len(parent))])
+    _, clusters = np.unique(clusters, return_inverse=True)
+    n_duplicates = len(clusters) - len(np.unique(clusters))
+    print('{} clusters, {} near-duplicate images'.format(clusters.max() + 1 if len(clusters) else 0, n_duplicates))
+    return clusters
+
+
+def split_by_cluster(index, clusters, test_size=0.2, valid_size=0.1, max_cluster_size=None, seed=None):
+    #클러스터 단위로 train, valid, test 를 나눠서 같은 클러스터가 여러 세트에 들어가지 않게 한다
+    #max_cluster_size : 큰 클러스터는 이 수 만큼만 남긴다
+    rng = np.random.default_rng(seed)
+    members = {}
+    for i, cluster in enumerate(clusters):
+        members.setdefault(cluster, []).append(i)
+    cluster_ids = list(members)
+    rng.shuffle(cluster_ids)
+
+    targets = np.array([1. - test_size - valid_size, valid_size, test_size])
+    splits = [[], [], []]
+    for cluster in cluster_ids:
+        rows = members[cluster]
+        if max_cluster_size and len(rows) > max_cluster_size:
+            rows = list(rng.choice(rows, max_cluster_size, replace=False))
+        #목표 비율보다 가장 부족한 세트에 넣는다
+        sizes = np.array([len(split) for split in splits], dtype=np.float64)
+        deficit = targets * (sizes.sum() + len(rows)) - sizes
+        splits[int(np.argmax(deficit))].extend(rows)
+
+    paths = index['paths']
+    #kfood_dataset.split_image_paths 와 같은 순서 (train, valid, test)
+    return [[str(paths[i]) for i in rng.permutation(split)] for split in splits]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--index-path', default=str(HASH_INDEX_PATH))
+    parser.add_argument('--radius', type=int, default=HASH_RADIUS)
+    args = parser.parse_args()
+
+    from kfood_manifest import get_manifest
+    index = build_hash_index(get_manifest(args.dataset_path), args.index_path)
+    find_duplicate_clusters(index, args.radius)
@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import random
+import argparse
+import subprocess
+from pathlib import Path
+
+#tensorflow 는 worker 프로세스에서 코어를 고정한 뒤에 import 한다
+BASE_PORT = 23456
+HOSTS = ('localhost',)
+
+
+def get_cluster_spec(hosts=HOSTS, n_workers=2, base_port=BASE_PORT):
+    #호스트마다 n_workers 개의 worker, 포트는 base_port 부터
+    return {'worker': ['{}:{}'.format(host, base_port + i) for host in hosts for i in range(n_workers)]}
+
+
+def get_tf_config(cluster_spec, worker_index):
+    return json.dumps({'cluster': cluster_spec, 'task': {'type': 'worker', 'index': worker_index}})
+
+
+def get_core_sets(n_workers, cores=None):
+    #사용 가능한 코어를 worker 수로 나눈다, 남는 코어는 앞 worker 부터 하나씩
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0))
+    size, extra = divmod(len(cores), n_workers)
+    if size == 0:
+        raise ValueError('{} workers for {} cores'.format(n_workers, len(cores)))
+    core_sets, start = [], 0
+    for i in range(n_workers):
+        end = start + size + (1 if i < extra else 0)
+        core_sets.append(cores[start:end])
+        start = end
+    return core_sets
+
+
+def shard_paths(filepaths, n_shards, index):
+    return filepaths[index::n_shards]
+
+
+def get_strategy():
+    import tensorflow as tf
+    #TF_CONFIG 로 클러스터를 찾는다, CPU 끼리는 RING all-reduce
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+def shard_dataset(dataset):
+    import tensorflow as tf
+    #경로를 이미 worker 별로 나눴으므로 tf.distribute 의 자동 샤딩은 끈다
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return dataset.with_options(options)
+
+
+def run_worker(args):
+    #한 worker : 코어 고정 -> 경로 샤딩 -> train.train(strategy=...)
+    n_total = len(args.hosts) * args.n_workers
+    worker_index = args.host_index * args.n_workers + args.local_index
+    cores = get_core_sets(args.n_workers)[args.local_index]
+    os.sched_setaffinity(0, cores)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    strategy = get_strategy()
+
+    import kfood_dataset
+    import train
+    #모든 worker 가 같은 split 을 갖도록 같은 seed 로 섞는다
+    paths = kfood_dataset.get_image_paths(args.dataset_path, shuffle=False)
+    random.Random(args.seed).shuffle(paths)
+    train_paths, valid_paths, _ = kfood_dataset.split_image_paths(paths)
+    #worker 마다 step 수가 같아야 한다 (동기 all-reduce), 가장 작은 샤드 기준
+    steps_per_epoch = len(train_paths) // n_total // args.batch_size
+    validation_steps = len(valid_paths) // n_total // args.batch_size
+    train_paths = shard_paths(train_paths, n_total, worker_index)
+    valid_paths = shard_paths(valid_paths, n_total, worker_index)
+    #keras fit 은 worker 데이터셋의 batch 를 global batch 로 보고 replica 수로 나눈다
+    #worker 마다 args.batch_size 가 되도록 global batch 로 묶는다 (한 step 에 worker 샤드에서 args.batch_size 개씩)
+    global_batch_size = args.batch_size * n_total
+    pipeline_config = kfood_dataset.PipelineConfig(n_parse_threads=len(cores))
+    train_set = shard_dataset(kfood_dataset.make_kfood_dataset(train_paths, batch_size=global_batch_size, pipeline_config=pipeline_config))
+    valid_set = shard_dataset(kfood_dataset.make_kfood_dataset(valid_paths, batch_size=global_batch_size, randomize=False, pipeline_config=pipeline_config))
+
+    train_property = {
+        'optimizer' : {
+            'name' : 'RMSprop',
+            'lr_decay': 0.94,
+            'kwargs' : {
+                'learning_rate' : args.learning_rate,
+                'rho' : 0.9,
+                'epsilon' : 1.0,
+                }
+        },
+        'batch': str(global_batch_size),
+        'crop' : 'random',
+    }
+    train.train(
+        train_set, valid_set, steps_per_epoch, validation_steps,
+        epochs=args.epochs,
+        weights_save_path=Path(args.weights_save_path),
+        train_property=train_property,
+        model_name=args.model_name,
+        strategy=strategy,
+    )
+
+
+def launch_workers(args):
+    #이 호스트의 worker 들을 띄운다, 다른 호스트에서는 --host-index 를 바꿔 같은 명령을 실행한다
+    cluster_spec = get_cluster_spec(args.hosts, args.n_workers, args.base_port)
+    processes = []
+    for local_index in range(args.n_workers):
+        worker_index = args.host_index * args.n_workers + local_index
+        env = dict(os.environ, TF_CONFIG=get_tf_config(cluster_spec, worker_index))
+        command = [sys.executable, __file__, '--local-index', str(local_index)] + sys.argv[1:]
+        processes.append(subprocess.Popen(command, env=env))
+    print('{} workers started : {}'.format(len(processes), cluster_spec['worker']))
+    return [process.wait() for process in processes]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--n-workers', type=int, default=2, help='호스트 당 worker 수')
+    parser.add_argument('--hosts', nargs='+', default=list(HOSTS))
+    parser.add_argument('--host-index', type=int, default=0)
+    parser.add_argument('--base-port', type=int, default=BASE_PORT)
+    parser.add_argument('--local-index', type=int, default=None, help='launch_workers 가 붙인다')
+    parser.add_argument('--batch-size', type=int, default=32, help='worker 당 batch, 데이터셋과 훈련 이름의 batch 는 worker 수 배의 global batch')
+    parser.add_argument('--learning-rate', type=float, default=0.045, help='worker 1 개 기준, worker 수 만큼 키운다')
+    parser.add_argument('--epochs', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--model-name', default='KerasInceptionResNetV2')
+    parser.add_argument('--weights-save-path', default='drive/MyDrive/Model/kfood', help='여러 호스트면 모든 호스트가 공유하는 경로 (이어서 훈련할 state 를 같이 읽는다)')
+    args = parser.parse_args()
+
+    if args.local_index is None:
+        sys.exit(max(launch_workers(args)))
+    run_worker(args)
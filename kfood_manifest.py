@@ -0,0 +1,123 @@
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import kfood_dataset
+
+IMAGE_FORMATS = ('png', 'jpg', 'jpeg', 'gif', 'bmp')
+MANIFEST_PATH = kfood_dataset.DRIVE_PATH / 'kfood_manifest.npz'
+N_SCAN_THREADS = 16
+
+#paths, labels, sizes, formats, crops 는 이미지 당 한 행
+#class_ids 는 각 행의 class_dirs 인덱스, class_mtimes 는 증분 갱신에 사용한다
+MANIFEST_COLUMNS = ('paths', 'labels', 'sizes', 'formats', 'crops', 'class_ids')
+
+
+def scan_class_dir(class_dir):
+    entries = []
+    with os.scandir(class_dir) as it:
+        for entry in it:
+            image_format = entry.name.split('.')[-1].lower()
+            if image_format not in IMAGE_FORMATS or not entry.is_file():
+                continue
+            entries.append((class_dir + '/' + entry.name, entry.stat().st_size, image_format))
+    return sorted(entries)
+
+
+def load_manifest(manifest_path=MANIFEST_PATH):
+    if not os.path.exists(manifest_path):
+        return None
+    with np.load(manifest_path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def build_manifest(dataset_path='kfood', manifest_path=MANIFEST_PATH, n_threads=N_SCAN_THREADS):
+    print('building manifest...')
+    class_dirs, class_mtimes = kfood_dataset.get_crop_sources(dataset_path)
+    LABELS, CLASSES = kfood_dataset.get_class_index()
+    class_to_label = dict(zip(CLASSES.tolist(), LABELS.tolist()))
+    crop_points = kfood_dataset.get_crop_points()
+
+    #이전 manifest 에서 수정 시간이 같은 클래스 디렉토리는 다시 읽지 않는다
+    old = load_manifest(manifest_path)
+    old_rows = {}
+    if old is not None:
+        for class_id, (class_dir, class_mtime) in enumerate(zip(old['class_dirs'], old['class_mtimes'])):
+            old_rows[class_dir] = (class_mtime, np.flatnonzero(old['class_ids'] == class_id))
+
+    changed_dirs = [class_dir for class_dir, class_mtime in zip(class_dirs, class_mtimes)
+                    if class_dir not in old_rows or old_rows[class_dir][0] != class_mtime]
+    print('{} / {} class directories changed'.format(len(changed_dirs), len(class_dirs)))
+    with ThreadPoolExecutor(n_threads) as executor:
+        scanned = dict(zip(changed_dirs, executor.map(scan_class_dir, changed_dirs)))
+
+    columns = {key: [] for key in MANIFEST_COLUMNS}
+    for class_id, class_dir in enumerate(class_dirs):
+        class_name = class_dir.split('/')[-1]
+        if class_name not in class_to_label:
+            print('unknown class, skipped :', class_dir)
+            continue
+        if class_dir in scanned:
+            paths = [path for path, _, _ in scanned[class_dir]]
+            sizes = [size for _, size, _ in scanned[class_dir]]
+            formats = [image_format for _, _, image_format in scanned[class_dir]]
+            crops = [crop_points.get(path.split('/')[-1].split('.')[0], kfood_dataset.NO_CROP) for path in paths]
+        else:
+            rows = old_rows[class_dir][1]
+            paths, sizes, formats, crops = old['paths'][rows], old['sizes'][rows], old['formats'][rows], old['crops'][rows]
+        columns['paths'].extend(paths)
+        columns['sizes'].extend(sizes)
+        columns['formats'].extend(formats)
+        columns['crops'].extend(crops)
+        columns['labels'].extend([class_to_label[class_name]] * len(paths))
+        columns['class_ids'].extend([class_id] * len(paths))
+
+    manifest = {
+        'paths': np.array(columns['paths'], dtype=str),
+        'labels': np.array(columns['labels'], dtype=np.int16),
+        'sizes': np.array(columns['sizes'], dtype=np.int64),
+        'formats': np.array(columns['formats'], dtype=str),
+        'crops': np.array(columns['crops'], dtype=np.int32).reshape(-1, 4),
+        'class_ids': np.array(columns['class_ids'], dtype=np.int32),
+        'class_dirs': class_dirs,
+        'class_mtimes': class_mtimes,
+    }
+    np.savez(manifest_path, **manifest)
+    print('manifest ready! {} images'.format(len(manifest['paths'])))
+    return manifest
+
+
+def get_manifest(dataset_path='kfood', manifest_path=MANIFEST_PATH):
+    manifest = load_manifest(manifest_path)
+    if manifest is not None:
+        class_dirs, class_mtimes = kfood_dataset.get_crop_sources(dataset_path)
+        if np.array_equal(manifest['class_dirs'], class_dirs) and np.array_equal(manifest['class_mtimes'], class_mtimes):
+            return manifest
+    return build_manifest(dataset_path, manifest_path)
+
+
+def select_manifest(manifest, index):
+    selected = {key: manifest[key][index] for key in MANIFEST_COLUMNS}
+    selected['class_dirs'] = manifest['class_dirs']
+    selected['class_mtimes'] = manifest['class_mtimes']
+    return selected
+
+
+def split_manifest(manifest, test_size=0.2, valid_size=0.1, shuffle=True):
+    index = np.arange(len(manifest['paths']))
+    if shuffle:
+        np.random.shuffle(index)
+    return [select_manifest(manifest, split_index) for split_index in kfood_dataset.split_image_paths(index, test_size, valid_size)]
+
+
+def filter_manifest(manifest, image_formats=IMAGE_FORMATS):
+    return select_manifest(manifest, np.isin(manifest['formats'], image_formats))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--manifest-path', default=str(MANIFEST_PATH))
+    args = parser.parse_args()
+    get_manifest(args.dataset_path, args.manifest_path)
@@ -0,0 +1,130 @@
+import os
+import csv
+import argparse
+from pathlib import Path
+import tensorflow as tf
+
+import kfood_dataset
+
+SHARD_MAX_SIZE = kfood_dataset.BOUNDED_SIZE
+SHARD_JPEG_QUALITY = 95
+N_SHARDS = 64
+N_INTERLEAVE = 16
+SHARD_SHUFFLE_BUFFER = 10000
+SHARD_DIR = 'kfood_shards'
+
+SHARD_FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64),
+    'height': tf.io.FixedLenFeature([], tf.int64),
+    'width': tf.io.FixedLenFeature([], tf.int64),
+    'name': tf.io.FixedLenFeature([], tf.string),
+}
+
+
+def encode_shard_image(tf_filepath, label, max_size=SHARD_MAX_SIZE):
+    image, label = kfood_dataset.parse_and_crop_image(tf_filepath, label)
+    image = kfood_dataset.bounded_resize(image, max_size)
+    shape = tf.shape(image)
+    name = tf.strings.split(tf.strings.split(tf_filepath, "/")[-1], ".")[0]
+    return tf.io.encode_jpeg(image, quality=SHARD_JPEG_QUALITY), label, shape[0], shape[1], name
+
+
+def serialize_shard_example(image, label, height, width, name):
+    feature = {
+        'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image])),
+        'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+        'height': tf.train.Feature(int64_list=tf.train.Int64List(value=[height])),
+        'width': tf.train.Feature(int64_list=tf.train.Int64List(value=[width])),
+        'name': tf.train.Feature(bytes_list=tf.train.BytesList(value=[name])),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def get_shard_name(shard, n_shards):
+    return 'shard-{:05d}-of-{:05d}'.format(shard, n_shards)
+
+
+def write_kfood_shards(filepaths, shard_dir=SHARD_DIR, n_shards=N_SHARDS, max_size=SHARD_MAX_SIZE, n_parse_threads=tf.data.AUTOTUNE):
+    print('writing shards to', shard_dir)
+    shard_dir = Path(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    labels = kfood_dataset.get_labels(filepaths)
+    n_shards = min(n_shards, len(filepaths))
+
+    shard_counts = []
+    for shard in range(n_shards):
+        shard_name = get_shard_name(shard, n_shards)
+        dataset = tf.data.Dataset.from_tensor_slices((filepaths[shard::n_shards], labels[shard::n_shards]))
+        dataset = dataset.map(lambda filepath, label: encode_shard_image(filepath, label, max_size), num_parallel_calls=n_parse_threads)
+        #디코딩 할 수 없는 이미지는 건너뛴다
+        dataset = dataset.apply(tf.data.experimental.ignore_errors())
+
+        #index : 이미지 이름, 레이블, 크기, 샤드 안에서의 바이트 오프셋
+        offset = 0
+        count = 0
+        with tf.io.TFRecordWriter(str(shard_dir / (shard_name + '.tfrecord'))) as writer, \
+                open(shard_dir / (shard_name + '.index'), 'w', newline='', encoding='utf8') as index_file:
+            index_writer = csv.writer(index_file)
+            for image, label, height, width, name in dataset.as_numpy_iterator():
+                record = serialize_shard_example(image, label, height, width, name)
+                writer.write(record)
+                index_writer.writerow([name.decode('utf8'), label, height, width, offset])
+                #TFRecord : length(8) + crc(4) + data + crc(4)
+                offset += len(record) + 16
+                count += 1
+        shard_counts.append((shard_name, count))
+        print('{} : {} images'.format(shard_name, count))
+
+    with open(shard_dir / 'shards.csv', 'w', newline='', encoding='utf8') as f:
+        csv.writer(f).writerows(shard_counts)
+    print('shards ready!')
+    return shard_counts
+
+
+def get_shard_paths(shard_dir=SHARD_DIR):
+    return sorted(str(path) for path in Path(shard_dir).glob('*.tfrecord'))
+
+
+def count_shard_examples(shard_dir=SHARD_DIR):
+    with open(Path(shard_dir) / 'shards.csv', 'r', encoding='utf8') as f:
+        return sum(int(count) for _, count in csv.reader(f))
+
+
+def parse_shard_example(serialized):
+    example = tf.io.parse_single_example(serialized, SHARD_FEATURES)
+    image = tf.io.decode_jpeg(example['image'], channels=3)
+    return image, example['label']
+
+
+def read_kfood_shards(shard_paths, n_parse_threads=5, shuffle_buffer_size=SHARD_SHUFFLE_BUFFER, repeat=True):
+    if isinstance(shard_paths, (str, Path)):
+        shard_paths = get_shard_paths(shard_paths)
+
+    dataset = tf.data.Dataset.from_tensor_slices(shard_paths)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.shuffle(len(shard_paths))
+    dataset = dataset.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=min(len(shard_paths), N_INTERLEAVE),
+        num_parallel_calls=n_parse_threads,
+    )
+    #직렬화된 레코드 상태로 섞는다
+    dataset = dataset.shuffle(shuffle_buffer_size)
+    return dataset.map(parse_shard_example, num_parallel_calls=n_parse_threads)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--shard-dir', default=SHARD_DIR)
+    parser.add_argument('--n-shards', type=int, default=N_SHARDS)
+    parser.add_argument('--max-size', type=int, default=SHARD_MAX_SIZE)
+    args = parser.parse_args()
+
+    paths = kfood_dataset.get_image_paths(args.dataset_path)
+    train_paths, valid_paths, test_paths = kfood_dataset.split_image_paths(paths)
+    for split, split_paths in (('train', train_paths), ('valid', valid_paths), ('test', test_paths)):
+        write_kfood_shards(split_paths, Path(args.shard_dir) / split, args.n_shards, args.max_size)
@@ -0,0 +1,88 @@
+import os
+import argparse
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+
+import kfood_dataset
+
+STORE_DIR = 'kfood_store'
+#random crop(90%) 후에도 299 에 가깝도록 조금 크게 저장한다
+STORE_SIZE = (320, 320)
+READ_BATCH = 64
+SPLITS = ('train', 'valid', 'test')
+
+
+def store_image(tf_filepath, label, store_size=STORE_SIZE):
+    image, label = kfood_dataset.parse_and_crop_image(tf_filepath, label)
+    image = kfood_dataset.central_crop(image)
+    image = tf.image.resize(image, store_size, method='area')
+    return tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8), label
+
+
+def build_image_store(image_paths, store_dir=STORE_DIR, store_size=STORE_SIZE, n_parse_threads=tf.data.AUTOTUNE):
+    #images.npy : N x H x W x 3 uint8, labels.npy : N (디코딩 실패는 -1), offsets.npy : train, valid, test 시작 위치
+    print('building image store...')
+    store_dir = Path(store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+
+    splits = kfood_dataset.split_image_paths(image_paths)
+    filepaths = [filepath for split in splits for filepath in split]
+    offsets = np.cumsum([0] + [len(split) for split in splits])
+    labels = kfood_dataset.get_labels(filepaths)
+
+    images = np.lib.format.open_memmap(store_dir / 'images.npy', mode='w+', dtype=np.uint8, shape=(len(filepaths), *store_size, 3))
+    stored_labels = np.full(len(filepaths), -1, dtype=np.int32)
+
+    dataset = tf.data.Dataset.from_tensor_slices((filepaths, labels)).enumerate()
+    dataset = dataset.map(lambda i, element: (i, *store_image(element[0], element[1], store_size)), num_parallel_calls=n_parse_threads)
+    dataset = dataset.apply(tf.data.experimental.ignore_errors())
+    for i, image, label in dataset.as_numpy_iterator():
+        images[i] = image
+        stored_labels[i] = label
+    images.flush()
+
+    np.save(store_dir / 'labels.npy', stored_labels)
+    np.save(store_dir / 'offsets.npy', offsets)
+    np.save(store_dir / 'paths.npy', np.array(filepaths, dtype=str))
+    print('image store ready! {} / {} images'.format(np.sum(stored_labels >= 0), len(filepaths)))
+
+
+def load_image_store(store_dir=STORE_DIR, split='train'):
+    #images 는 memmap 그대로, 읽을 때 page cache 에서 가져온다
+    store_dir = Path(store_dir)
+    images = np.load(store_dir / 'images.npy', mmap_mode='r')
+    labels = np.load(store_dir / 'labels.npy')
+    offsets = np.load(store_dir / 'offsets.npy')
+    start, end = offsets[SPLITS.index(split)], offsets[SPLITS.index(split) + 1]
+    return {'images': images[start:end], 'labels': labels[start:end]}
+
+
+def read_image_store(store, n_parse_threads=5, repeat=True, read_batch=READ_BATCH):
+    images, labels = store['images'], store['labels']
+    index = np.flatnonzero(labels >= 0)
+
+    def gather(batch_index):
+        #정렬된 인덱스로 읽으면 memmap 접근이 순차에 가까워진다
+        batch_index = np.sort(batch_index)
+        return images[batch_index], labels[batch_index]
+
+    dataset = tf.data.Dataset.from_tensor_slices(index)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.shuffle(len(index))
+    dataset = dataset.batch(read_batch)
+    dataset = dataset.map(lambda batch_index: tf.numpy_function(gather, [batch_index], (tf.uint8, tf.int32)), num_parallel_calls=n_parse_threads)
+    dataset = dataset.map(lambda image, label: (tf.ensure_shape(image, [None, *images.shape[1:]]), tf.ensure_shape(label, [None])))
+    return dataset.unbatch()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--store-dir', default=STORE_DIR)
+    parser.add_argument('--size', type=int, default=STORE_SIZE[0])
+    args = parser.parse_args()
+
+    paths = kfood_dataset.get_image_paths(args.dataset_path)
+    build_image_store(paths, args.store_dir, (args.size, args.size))
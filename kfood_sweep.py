@@ -0,0 +1,268 @@
+import os
+import csv
+import json
+import copy
+import random
+import argparse
+import itertools
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from kfood_distributed import get_core_sets
+
+SWEEP_DIR = 'kfood_sweep'
+#model_name 외의 키는 train_property 의 (점으로 구분한) 경로
+SEARCH_SPACE = {
+    'model_name': ['SmallKerasInceptionResNetV2', 'InceptionResNetV2'],
+    'optimizer.name': ['RMSprop', 'Adam'],
+    'optimizer.kwargs.learning_rate': [0.045, 0.01, 0.001],
+    'optimizer.lr_decay': [0.94, 0.9],
+}
+BASE_TRAIN_PROPERTY = {
+    'optimizer' : {
+        'name' : 'RMSprop',
+        'lr_decay': 0.94,
+        'kwargs' : {
+            'learning_rate' : 0.045,
+            'epsilon' : 1.0,
+            }
+    },
+    'batch': '32',
+    'crop' : 'random',
+}
+#optimizer 마다 받는 인자가 다르다
+OPTIMIZER_KWARGS = {
+    'SGD': {'momentum': 0.9},
+    'RMSprop': {'rho': 0.9, 'epsilon': 1.0},
+    'Adam': {},
+}
+
+
+def get_trials(search_space=SEARCH_SPACE, n_trials=None, seed=0):
+    #n_trials 가 없으면 전체 grid, 있으면 grid 에서 n_trials 개를 뽑는다
+    keys = sorted(search_space)
+    grid = [dict(zip(keys, values)) for values in itertools.product(*(search_space[key] for key in keys))]
+    if n_trials is not None and n_trials < len(grid):
+        grid = random.Random(seed).sample(grid, n_trials)
+    trials = []
+    for i, params in enumerate(grid):
+        train_property = copy.deepcopy(BASE_TRAIN_PROPERTY)
+        model_name = params.get('model_name', 'KerasInceptionResNetV2')
+        for key, value in params.items():
+            if key == 'model_name':
+                continue
+            *parents, name = key.split('.')
+            node = train_property
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            node[name] = value
+        #optimizer 기본 인자 위에 search space 가 정한 optimizer.kwargs.* 를 덮어쓴다
+        optimizer = train_property['optimizer']
+        searched = {key.split('.', 2)[2]: value for key, value in params.items() if key.startswith('optimizer.kwargs.')}
+        kwargs = dict(OPTIMIZER_KWARGS.get(optimizer['name'], {}), learning_rate=BASE_TRAIN_PROPERTY['optimizer']['kwargs']['learning_rate'])
+        kwargs.update(searched)
+        optimizer['kwargs'] = kwargs
+        trials.append({'trial_id': 'trial_{:03d}'.format(i), 'model_name': model_name, 'params': params, 'train_property': train_property})
+    return trials
+
+
+def get_rungs(min_epochs=2, max_epochs=54, eta=3):
+    #[2, 6, 18, 54]
+    rungs = [min_epochs]
+    while rungs[-1] * eta < max_epochs:
+        rungs.append(rungs[-1] * eta)
+    if rungs[-1] != max_epochs:
+        rungs.append(max_epochs)
+    return rungs
+
+
+class ASHA:
+    #asynchronous successive halving : rung 에서 상위 1/eta 에 든 trial 만 다음 rung 으로 올린다
+    #다른 trial 을 기다리지 않고 빈 worker 마다 바로 다음 job 을 정한다
+    def __init__(self, trials, rungs, eta=3):
+        self.trials = {trial['trial_id']: trial for trial in trials}
+        self.pending = [trial['trial_id'] for trial in trials]
+        self.rungs = rungs
+        self.eta = eta
+        self.results = [{} for _ in rungs]
+        self.promoted = [set() for _ in rungs]
+
+    def next_job(self):
+        #(trial_id, rung), 지금 할 수 있는 job 이 없으면 None
+        for rung in reversed(range(len(self.rungs) - 1)):
+            results = self.results[rung]
+            n_promote = len(results) // self.eta
+            top = sorted(results, key=results.get, reverse=True)[:n_promote]
+            for trial_id in top:
+                if trial_id not in self.promoted[rung]:
+                    self.promoted[rung].add(trial_id)
+                    return trial_id, rung + 1
+        if self.pending:
+            return self.pending.pop(0), 0
+        return None
+
+    def report(self, trial_id, rung, val_accuracy):
+        self.results[rung][trial_id] = val_accuracy
+
+    def leaderboard(self):
+        rows = []
+        for trial_id, trial in self.trials.items():
+            reached = [rung for rung in range(len(self.rungs)) if trial_id in self.results[rung]]
+            if not reached:
+                continue
+            rung = reached[-1]
+            rows.append({
+                'trial_id': trial_id,
+                'model_name': trial['model_name'],
+                'params': json.dumps(trial['params'], ensure_ascii=False),
+                'epochs': self.rungs[rung],
+                'val_accuracy': self.results[rung][trial_id],
+            })
+        return sorted(rows, key=lambda row: (row['epochs'], row['val_accuracy']), reverse=True)
+
+
+def init_worker(cores):
+    #worker 프로세스는 sweep 동안 같은 코어 집합을 쓴다
+    os.sched_setaffinity(0, cores)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+
+
+def load_rung_results(trial_dir):
+    #epochs -> val_accuracy, 같은 sweep_dir 로 다시 실행할 때 이미 끝난 rung 은 훈련하지 않는다
+    path = Path(trial_dir) / 'rungs.json'
+    if not path.exists():
+        return {}
+    with open(path, encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_rung_result(trial_dir, epochs, val_accuracy):
+    results = load_rung_results(trial_dir)
+    results[str(epochs)] = val_accuracy
+    os.makedirs(trial_dir, exist_ok=True)
+    with open(Path(trial_dir) / 'rungs.json', 'w', encoding='utf8') as f:
+        json.dump(results, f)
+
+
+def run_trial(trial, epochs, sweep_dir, dataset_path, steps_per_epoch=None, seed=0):
+    #trial 디렉토리의 훈련 상태 (train.train 의 state) 에서 이어서 epochs 까지 훈련한다
+    trial_dir = Path(sweep_dir) / 'trials' / trial['trial_id']
+    recorded = load_rung_results(trial_dir)
+    if str(epochs) in recorded:
+        return recorded[str(epochs)]
+
+    from tensorflow import keras
+    import kfood_dataset
+    import train
+    keras.backend.clear_session()
+
+    paths = kfood_dataset.get_image_paths(dataset_path, shuffle=False)
+    random.Random(seed).shuffle(paths)
+    train_paths, valid_paths, _ = kfood_dataset.split_image_paths(paths)
+    batch_size = int(trial['train_property']['batch'])
+    n_threads = len(os.sched_getaffinity(0))
+    pipeline_config = kfood_dataset.PipelineConfig(n_parse_threads=n_threads)
+    train_set = kfood_dataset.make_kfood_dataset(train_paths, batch_size=batch_size, pipeline_config=pipeline_config)
+    valid_set = kfood_dataset.make_kfood_dataset(valid_paths, batch_size=batch_size, randomize=False, pipeline_config=pipeline_config)
+
+    _, history = train.train(
+        train_set, valid_set,
+        steps_per_epoch or len(train_paths) // batch_size,
+        len(valid_paths) // batch_size,
+        epochs=epochs,
+        weights_save_path=trial_dir,
+        train_property=trial['train_property'],
+        model_name=trial['model_name'],
+        save_weights_per_epoch=False,
+        profile=False,
+    )
+    #state 가 이미 epochs 이상이면 fit 이 한 에폭도 돌지 않는다
+    if not history.history.get('val_accuracy'):
+        raise RuntimeError('{} is already trained past {} epochs without a recorded result'.format(trial['trial_id'], epochs))
+    val_accuracy = history.history['val_accuracy'][-1]
+    save_rung_result(trial_dir, epochs, val_accuracy)
+    return val_accuracy
+
+
+def write_leaderboard(scheduler, sweep_dir):
+    rows = scheduler.leaderboard()
+    with open(Path(sweep_dir) / 'leaderboard.csv', 'w', newline='', encoding='utf8') as f:
+        writer = csv.DictWriter(f, fieldnames=['trial_id', 'model_name', 'params', 'epochs', 'val_accuracy'])
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def run_sweep(trials, dataset_path='kfood', sweep_dir=SWEEP_DIR, n_workers=2, min_epochs=2, max_epochs=54, eta=3, steps_per_epoch=None, seed=0):
+    os.makedirs(sweep_dir, exist_ok=True)
+    rungs = get_rungs(min_epochs, max_epochs, eta)
+    scheduler = ASHA(trials, rungs, eta)
+    print('{} trials, rungs (epochs) : {}'.format(len(trials), rungs))
+
+    #코어 집합 하나 당 프로세스 하나인 executor
+    context = multiprocessing.get_context('spawn')
+    executors = [ProcessPoolExecutor(1, mp_context=context, initializer=init_worker, initargs=(cores,)) for cores in get_core_sets(n_workers)]
+    running = {}
+    try:
+        while True:
+            for executor in executors:
+                if executor in running.values():
+                    continue
+                job = scheduler.next_job()
+                if job is None:
+                    break
+                trial_id, rung = job
+                future = executor.submit(run_trial, scheduler.trials[trial_id], rungs[rung], sweep_dir, dataset_path, steps_per_epoch, seed)
+                future.job = job
+                running[future] = executor
+                print('{} : rung {} ({} epochs)'.format(trial_id, rung, rungs[rung]))
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                trial_id, rung = future.job
+                try:
+                    val_accuracy = future.result()
+                except Exception as e:
+                    #실패한 trial 은 더 올리지 않는다
+                    print('{} failed : {}'.format(trial_id, e))
+                    continue
+                scheduler.report(trial_id, rung, val_accuracy)
+                print('{} : rung {} val_accuracy {:.4f}'.format(trial_id, rung, val_accuracy))
+                write_leaderboard(scheduler, sweep_dir)
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    rows = write_leaderboard(scheduler, sweep_dir)
+    total_epochs = sum(rungs[rung] - (rungs[rung - 1] if rung else 0) for rung, results in enumerate(scheduler.results) for _ in results)
+    print('epochs trained : {} (full grid {})'.format(total_epochs, len(trials) * max_epochs))
+    for row in rows[:10]:
+        print('{trial_id} {model_name} {params} : {val_accuracy:.4f} ({epochs} epochs)'.format(**row))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--sweep-dir', default=SWEEP_DIR)
+    parser.add_argument('--search-space', default=None, help='SEARCH_SPACE 형식의 json 파일')
+    parser.add_argument('--n-trials', type=int, default=None)
+    parser.add_argument('--n-workers', type=int, default=2)
+    parser.add_argument('--min-epochs', type=int, default=2)
+    parser.add_argument('--max-epochs', type=int, default=54)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--steps-per-epoch', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    search_space = SEARCH_SPACE
+    if args.search_space:
+        with open(args.search_space, encoding='utf8') as f:
+            search_space = json.load(f)
+    trials = get_trials(search_space, args.n_trials, args.seed)
+    run_sweep(trials, args.dataset_path, args.sweep_dir, args.n_workers, args.min_epochs, args.max_epochs, args.eta, args.steps_per_epoch, args.seed)
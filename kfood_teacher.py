@@ -0,0 +1,78 @@
+import os
+import argparse
+from pathlib import Path
+import numpy as np
+import tensorflow as tf
+
+import kfood_dataset
+
+TEACHER_DIR = 'kfood_teacher'
+LOGIT_EPSILON = 1e-7
+
+
+def teacher_image(tf_filepath, label):
+    #teacher 는 한번만 실행하므로 random crop 없이 central crop 으로 본다
+    image, label = kfood_dataset.parse_and_crop_image(tf_filepath, label)
+    return kfood_dataset.resizing_image(image, label, randomize=False)
+
+
+def build_teacher_store(teacher, image_paths, store_dir=TEACHER_DIR, batch_size=64, n_parse_threads=tf.data.AUTOTUNE):
+    #logits.npy : N x n_classes float16 (teacher softmax 의 log), paths.npy : N
+    #모델이 softmax 를 출력하므로 log 확률을 logit 으로 쓴다 (softmax 에서는 상수 차이만 난다)
+    print('building teacher store...')
+    store_dir = Path(store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    n_classes = teacher.output_shape[-1]
+
+    #디코딩에 실패한 이미지는 균등 분포로 남는다 (soft target 정보 없음)
+    logits = np.lib.format.open_memmap(store_dir / 'logits.npy', mode='w+', dtype=np.float16, shape=(len(image_paths), n_classes))
+    logits[:] = np.log(1. / n_classes)
+
+    dataset = tf.data.Dataset.from_tensor_slices(list(image_paths)).enumerate()
+    dataset = dataset.map(lambda i, filepath: (i, teacher_image(filepath, 0)[0]), num_parallel_calls=n_parse_threads)
+    dataset = dataset.apply(tf.data.experimental.ignore_errors())
+    dataset = dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+    predict = tf.function(lambda images: teacher(images, training=False))
+    n_done = 0
+    for index, images in dataset:
+        probabilities = predict(images).numpy()
+        logits[index.numpy()] = np.log(probabilities + LOGIT_EPSILON)
+        n_done += len(index)
+    logits.flush()
+
+    np.save(store_dir / 'paths.npy', np.array(image_paths, dtype=str))
+    print('teacher store ready! {} / {} images'.format(n_done, len(image_paths)))
+
+
+def load_teacher_store(store_dir=TEACHER_DIR):
+    store_dir = Path(store_dir)
+    return {
+        'logits': np.load(store_dir / 'logits.npy', mmap_mode='r'),
+        'paths': np.load(store_dir / 'paths.npy'),
+    }
+
+
+def get_teacher_logits(store, filepaths):
+    #filepaths 순서로 teacher logits 를 모은다, make_kfood_dataset(teacher_logits=...) 에 넘긴다
+    rows = {path: i for i, path in enumerate(store['paths'])}
+    missing = [filepath for filepath in filepaths if filepath not in rows]
+    if missing:
+        raise KeyError('{} images are not in the teacher store, ex) {}'.format(len(missing), missing[0]))
+    return np.asarray(store['logits'][[rows[filepath] for filepath in filepaths]])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('weights_path', help='teacher 가중치 (best.weights)')
+    parser.add_argument('--teacher', default='KerasInceptionResNetV2')
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--store-dir', default=TEACHER_DIR)
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    from train import build_model
+    teacher = build_model(args.teacher)
+    teacher.load_weights(args.weights_path)
+    paths = kfood_dataset.get_image_paths(args.dataset_path, shuffle=False)
+    build_teacher_store(teacher, paths, args.store_dir, args.batch_size)
@@ -0,0 +1,183 @@
+import os
+import csv
+import argparse
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+#긴 변 최대 길이, 4:3 이미지면 짧은 변 384 로 random crop(90%) 후에도 299 이상이 남는다
+TRANSCODE_MAX_SIDE = 512
+TRANSCODE_QUALITY = 90
+TRANSCODE_DIR = 'kfood_jpeg'
+NO_CROP = [-1, -1, -1, -1]
+STATS_COLUMNS = ('path', 'output_path', 'status', 'format', 'crop', 'max_side', 'quality', 'height', 'width', 'output_height', 'output_width', 'bytes', 'output_bytes', 'psnr')
+#이 값들이 이전 변환과 같아야 다시 변환하지 않는다
+SETTING_COLUMNS = ('path', 'crop', 'max_side', 'quality')
+
+
+def init_worker():
+    import tensorflow as tf
+    #프로세스 수 만큼 병렬이므로 프로세스 안에서는 스레드를 늘리지 않는다
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def get_job_stats(path, output_path, crop, max_side, quality):
+    #csv 로 저장, 비교하므로 설정 값은 문자열로 둔다
+    stats = dict.fromkeys(STATS_COLUMNS)
+    stats.update({
+        'path': path, 'output_path': output_path, 'format': path.split('.')[-1].lower(),
+        'crop': ' '.join(str(x) for x in crop), 'max_side': str(max_side), 'quality': str(quality),
+    })
+    return stats
+
+
+def load_stats(output_path=TRANSCODE_DIR):
+    #output_path : 이전 변환의 stats 행
+    stats_path = os.path.join(output_path, 'transcode_stats.csv')
+    if not os.path.exists(stats_path):
+        return {}
+    with open(stats_path, newline='', encoding='utf8') as f:
+        return {row['output_path']: row for row in csv.DictReader(f)}
+
+
+def is_up_to_date(stats, old_stats):
+    #이전에 같은 원본, 크롭, max_side, quality 로 변환했고 그 뒤로 원본이 바뀌지 않았으면 건너뛴다
+    old = old_stats.get(stats['output_path'])
+    if old is None or old['status'] not in ('ok', 'skipped'):
+        return False
+    if any(old.get(key) != stats[key] for key in SETTING_COLUMNS):
+        return False
+    output_path = stats['output_path']
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(stats['path'])
+
+
+def transcode_image(args):
+    import tensorflow as tf
+    path, output_path, crop, max_side, quality = args
+    stats = get_job_stats(path, output_path, crop, max_side, quality)
+    try:
+        contents = tf.io.read_file(path)
+        image = tf.image.decode_image(contents, channels=3, expand_animations=False)
+    except (tf.errors.InvalidArgumentError, tf.errors.NotFoundError):
+        stats['status'] = 'decode error'
+        return stats
+    stats['height'], stats['width'] = int(image.shape[0]), int(image.shape[1])
+
+    if list(crop) != NO_CROP:
+        #crop : (offset_height, offset_width, target_height, target_width)
+        #numpy slice 는 범위 밖의 크롭을 잘라내므로 (tf.image.crop_to_bounding_box 는 에러) 먼저 검사한다
+        if min(crop) < 0 or crop[0] + crop[2] > stats['height'] or crop[1] + crop[3] > stats['width']:
+            stats['status'] = 'bad_crop'
+            return stats
+        image = image[crop[0]:crop[0] + crop[2], crop[1]:crop[1] + crop[3]]
+    height, width = int(image.shape[0]), int(image.shape[1])
+    if height == 0 or width == 0:
+        stats['status'] = 'empty crop'
+        return stats
+    if max(height, width) > max_side:
+        scale = max_side / max(height, width)
+        size = (max(round(height * scale), 1), max(round(width * scale), 1))
+        image = tf.image.resize(image, size, method='area')
+        image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+
+    #baseline JPEG (progressive=False)
+    encoded = tf.io.encode_jpeg(image, quality=quality, progressive=False, optimize_size=True)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tf.io.write_file(output_path, encoded)
+
+    decoded = tf.io.decode_jpeg(encoded, channels=3)
+    stats.update({
+        'status': 'ok',
+        'output_height': int(image.shape[0]),
+        'output_width': int(image.shape[1]),
+        'bytes': os.path.getsize(path),
+        'output_bytes': len(encoded.numpy()),
+        'psnr': float(tf.image.psnr(image, decoded, max_val=255)),
+    })
+    return stats
+
+
+def transcode_dataset(image_paths, dataset_path='kfood', output_path=TRANSCODE_DIR, max_side=TRANSCODE_MAX_SIDE, quality=TRANSCODE_QUALITY, n_workers=None):
+    #image_paths 를 output_path 아래 같은 구조의 baseline JPEG 로 변환, crop_area.properties 크롭은 적용된 상태
+    #변환된 데이터셋은 make_kfood_dataset(..., properties_crop=False) 로 읽는다
+    import kfood_dataset
+    crop_points = kfood_dataset.get_crop_points()
+    jobs = []
+    for path in image_paths:
+        relative = os.path.relpath(path, dataset_path)
+        target = os.path.join(output_path, os.path.splitext(relative)[0] + '.jpg')
+        crop = crop_points.get(os.path.basename(path).split('.')[0], NO_CROP)
+        jobs.append((path, target, list(crop), max_side, quality))
+
+    #같은 이름의 png, jpg 가 있으면 출력이 겹쳐 한쪽이 덮어써진다
+    sources = {}
+    for job in jobs:
+        sources.setdefault(job[1], []).append(job[0])
+    collisions = [paths for paths in sources.values() if len(paths) > 1]
+    if collisions:
+        raise ValueError('{} output names are shared by several images, ex) {}'.format(len(collisions), collisions[0]))
+    targets = list(sources)
+
+    old_stats = load_stats(output_path)
+    stats = [get_job_stats(*job) for job in jobs]
+    todo = []
+    for i, job_stats in enumerate(stats):
+        if is_up_to_date(job_stats, old_stats):
+            #다음 실행에서도 비교할 수 있도록 이전 행을 그대로 남긴다
+            stats[i] = dict(old_stats[job_stats['output_path']], status='skipped')
+        else:
+            todo.append(i)
+
+    print('transcoding {} / {} images to {}...'.format(len(todo), len(jobs), output_path))
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(n_workers, mp_context=context, initializer=init_worker) as executor:
+        for n, (i, result) in enumerate(zip(todo, executor.map(transcode_image, [jobs[i] for i in todo], chunksize=32))):
+            stats[i] = result
+            if (n + 1) % 5000 == 0:
+                print('{} / {}'.format(n + 1, len(todo)))
+
+    #디렉토리 구조를 맞추기 위해 빈 crop_area.properties 를 만든다
+    for class_dir in set(os.path.dirname(target) for target in targets):
+        os.makedirs(class_dir, exist_ok=True)
+        Path(class_dir, 'crop_area.properties').touch()
+
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, 'transcode_stats.csv'), 'w', newline='', encoding='utf8') as f:
+        writer = csv.DictWriter(f, fieldnames=STATS_COLUMNS)
+        writer.writeheader()
+        writer.writerows(stats)
+    summarize_stats(stats)
+    return stats
+
+
+def summarize_stats(stats):
+    done = [s for s in stats if s['status'] == 'ok']
+    print('ok : {}, skipped : {}, failed : {}'.format(
+        len(done), sum(s['status'] == 'skipped' for s in stats), sum(s['status'] not in ('ok', 'skipped') for s in stats)))
+    if not done:
+        return
+    source_bytes = sum(s['bytes'] for s in done)
+    output_bytes = sum(s['output_bytes'] for s in done)
+    psnrs = sorted(s['psnr'] for s in done)
+    print('size : {:.1f} MB -> {:.1f} MB ({:.1%})'.format(source_bytes / 2**20, output_bytes / 2**20, output_bytes / source_bytes))
+    print('psnr : mean {:.1f} dB, min {:.1f} dB'.format(sum(psnrs) / len(psnrs), psnrs[0]))
+    formats = {}
+    for s in done:
+        formats.setdefault(s['format'], []).append(s['output_bytes'] / s['bytes'])
+    for image_format, ratios in sorted(formats.items()):
+        print('{:>5} : {} images, size {:.1%}'.format(image_format, len(ratios), sum(ratios) / len(ratios)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--output-path', default=TRANSCODE_DIR)
+    parser.add_argument('--max-side', type=int, default=TRANSCODE_MAX_SIDE)
+    parser.add_argument('--quality', type=int, default=TRANSCODE_QUALITY)
+    parser.add_argument('--n-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    import kfood_dataset
+    paths = kfood_dataset.get_image_paths(args.dataset_path, image_formats=('png', 'jpg', 'jpeg', 'gif', 'bmp'), shuffle=False)
+    transcode_dataset(paths, args.dataset_path, args.output_path, args.max_side, args.quality, args.n_workers)
@@ -0,0 +1,215 @@
+import os
+import json
+import struct
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+#이 모듈은 tensorflow 없이 import 된다 (검사 프로세스가 tensorflow 를 올리지 않도록)
+VALIDATION_PATH = 'kfood_validation.json'
+CHUNK_SIZE = 5000
+NO_CROP = [-1, -1, -1, -1]
+
+IMAGE_EXTENSIONS = {
+    'jpg': 'jpeg',
+    'jpeg': 'jpeg',
+    'png': 'png',
+    'gif': 'gif',
+    'bmp': 'bmp',
+}
+#SOF 마커 (DHT, JPG, DAC 제외)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def get_image_kind(head):
+    if head[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:2] == b'BM':
+        return 'bmp'
+    return None
+
+
+def read_jpeg_size(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        #채움 바이트 0xFF
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD8:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if marker[1] in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            _, height, width = struct.unpack('>BHH', data)
+            return height, width
+        f.seek(length - 2, 1)
+
+
+def read_image_header(f, kind, head):
+    #(height, width), 헤더가 깨졌으면 None
+    if kind == 'jpeg':
+        return read_jpeg_size(f)
+    if kind == 'png' and len(head) >= 24 and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        return height, width
+    if kind == 'gif' and len(head) >= 10:
+        width, height = struct.unpack('<HH', head[6:10])
+        return height, width
+    if kind == 'bmp' and len(head) >= 26:
+        width, height = struct.unpack('<ii', head[18:26])
+        return abs(height), width
+    return None
+
+
+def has_image_trailer(f, kind):
+    f.seek(-12, 2)
+    tail = f.read(12)
+    if kind == 'jpeg':
+        return tail.endswith(b'\xff\xd9')
+    if kind == 'png':
+        return b'IEND' in tail
+    if kind == 'gif':
+        return tail.endswith(b'\x3b')
+    return True
+
+
+def check_crop(crop, height, width):
+    #crop : (offset_height, offset_width, target_height, target_width)
+    if list(crop) == NO_CROP:
+        return True
+    offset_height, offset_width, target_height, target_width = crop
+    return (offset_height >= 0 and offset_width >= 0 and target_height > 0 and target_width > 0
+            and offset_height + target_height <= height and offset_width + target_width <= width)
+
+
+def check_image_header(args):
+    #헤더만 읽는 검사, status 는 'ok', 'invalid', 'suspicious'(전체 디코딩 필요)
+    path, crop = args
+    try:
+        if os.path.getsize(path) == 0:
+            return path, 'invalid', 'empty file', None
+        with open(path, 'rb') as f:
+            head = f.read(32)
+            kind = get_image_kind(head)
+            if kind is None:
+                return path, 'invalid', 'unknown format', None
+            size = read_image_header(f, kind, head)
+            trailer = has_image_trailer(f, kind)
+    except OSError as e:
+        return path, 'invalid', 'read error : {}'.format(e), None
+
+    if size is None:
+        return path, 'suspicious', 'broken {} header'.format(kind), None
+    if not check_crop(crop, *size):
+        return path, 'invalid', 'crop {} out of image {}x{}'.format(list(crop), *size), size
+    if not trailer:
+        return path, 'suspicious', 'truncated {}'.format(kind), size
+    if IMAGE_EXTENSIONS.get(path.split('.')[-1].lower()) != kind:
+        return path, 'suspicious', '{} with .{} extension'.format(kind, path.split('.')[-1]), size
+    return path, 'ok', None, size
+
+
+def decode_image_file(args):
+    import tensorflow as tf
+    path, crop = args
+    try:
+        image = tf.image.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    except tf.errors.OpError as e:
+        #InvalidArgumentError 외에도 깨진 파일은 UnknownError, ResourceExhaustedError 등을 낸다, 한 파일 때문에 청크를 잃지 않는다
+        return path, 'invalid', 'decode error : {}'.format(e.message.splitlines()[0]), None
+    size = tuple(int(dim) for dim in image.shape[:2])
+    if not check_crop(crop, *size):
+        return path, 'invalid', 'crop {} out of image {}x{}'.format(list(crop), *size), size
+    return path, 'ok', None, size
+
+
+def load_validation(validation_path=VALIDATION_PATH):
+    if not os.path.exists(validation_path):
+        return {}
+    with open(validation_path, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_validation(results, validation_path=VALIDATION_PATH):
+    tmp_path = validation_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(results, f, ensure_ascii=False)
+    os.replace(tmp_path, validation_path)
+
+
+def validate_dataset(paths, crops=None, validation_path=VALIDATION_PATH, n_workers=None, chunk_size=CHUNK_SIZE):
+    #crops : 경로별 crop_area.properties 크롭, 없으면 kfood_dataset 의 crop 정보를 사용한다
+    #결과는 경로 -> {mtime, size, crop, status, reason} 로 저장, mtime/size/crop 이 같으면 다시 검사하지 않는다
+    #헤더 검사는 프로세스 풀에서, 의심스러운 파일의 전체 디코딩은 이 프로세스의 스레드 풀에서 한다 (tensorflow 디코딩은 GIL 을 놓는다)
+    if crops is None:
+        import kfood_dataset
+        crop_points = kfood_dataset.get_crop_points()
+        crops = [list(crop_points.get(os.path.basename(path).split('.')[0], NO_CROP)) for path in paths]
+
+    results = load_validation(validation_path)
+    todo = []
+    keys = {}
+    for path, crop in zip(paths, crops):
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            results[path] = {'mtime': None, 'size': None, 'crop': list(crop), 'status': 'invalid', 'reason': 'read error : {}'.format(e)}
+            continue
+        key = {'mtime': stat.st_mtime, 'size': stat.st_size, 'crop': [int(c) for c in crop]}
+        previous = results.get(path)
+        #결과는 검사가 끝난 뒤에만 저장되지만, status 가 없는 항목도 다시 검사한다
+        if previous is None or 'status' not in previous or any(previous.get(k) != v for k, v in key.items()):
+            keys[path] = key
+            todo.append((path, key['crop']))
+    print('validating {} / {} images'.format(len(todo), len(paths)))
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            checked = list(executor.map(check_image_header, chunk, chunksize=64))
+
+            #헤더가 의심스러운 파일만 전체 디코딩, 검사 프로세스가 tensorflow 를 올리지 않도록 디코딩은 이 프로세스의 스레드에서 한다
+            suspicious = [(path, keys[path]['crop']) for path, status, _, _ in checked if status == 'suspicious']
+            if suspicious:
+                with ThreadPoolExecutor(n_workers) as decoder:
+                    decoded = {result[0]: result for result in decoder.map(decode_image_file, suspicious)}
+                checked = [decoded.get(result[0], result) for result in checked]
+
+            for path, status, reason, size in checked:
+                results[path] = dict(keys[path], status=status, reason=reason)
+            #청크마다 저장해서 중단되어도 이어서 검사한다
+            save_validation(results, validation_path)
+            print('{} / {} checked'.format(min(start + chunk_size, len(todo)), len(todo)))
+
+    quarantine = {path: results[path]['reason'] for path in paths if results[path]['status'] != 'ok'}
+    print('{} images quarantined'.format(len(quarantine)))
+    return quarantine
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset-path', default='kfood')
+    parser.add_argument('--validation-path', default=VALIDATION_PATH)
+    parser.add_argument('--n-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    import kfood_dataset
+    paths = kfood_dataset.get_image_paths(args.dataset_path, image_formats=tuple(IMAGE_EXTENSIONS), shuffle=False)
+    quarantine = validate_dataset(paths, validation_path=args.validation_path, n_workers=args.n_workers)
+    for path, reason in sorted(quarantine.items()):
+        print(path, ':', reason)
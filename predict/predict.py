@@ -26,9 +26,15 @@ with open(os.path.join(str(Path(__file__).parent.parent),'class_to_label.txt'),'
 LABELS = np.array(LABELS)
 CLASSES = np.array(CLASSES)
 
-def predict():
+#XLA 로 컴파일한 추론 함수, 처음 호출할 때 (입력 크기가 바뀔 때) 컴파일한다
+jit_predict = tf.function(lambda images: model(images, training=False), jit_compile=True)
+
+def predict(jit_compile=False):
     images = preprocess() # n x 299 x 299 x 3
-    predicts = model.predict(images)  # n x 150
+    if jit_compile:
+        predicts = jit_predict(tf.convert_to_tensor(images, dtype=tf.float32)).numpy()
+    else:
+        predicts = model.predict(images)  # n x 150
     labels = np.argmax(predicts, axis=1) # n
     return images, CLASSES[labels]
 
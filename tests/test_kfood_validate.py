@@ -0,0 +1,71 @@
+import os
+import sys
+import zlib
+import struct
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+import kfood_validate
+
+NO_CROP = kfood_validate.NO_CROP
+
+
+def png_bytes(width=4, height=3):
+    #헤더 검사만 통과하면 되므로 IDAT 없이 IHDR, IEND 만 쓴다
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IEND', b'')
+
+
+@pytest.fixture
+def image_paths(tmp_path):
+    paths = []
+    for i in range(4):
+        path = tmp_path / 'Img_{}.png'.format(i)
+        path.write_bytes(png_bytes())
+        paths.append(str(path))
+    broken = tmp_path / 'Img_broken.png'
+    broken.write_bytes(b'not an image at all')
+    paths.append(str(broken))
+    return paths
+
+
+def test_resume_after_interrupt(image_paths, tmp_path, monkeypatch):
+    validation_path = str(tmp_path / 'validation.json')
+    crops = [NO_CROP] * len(image_paths)
+
+    #첫 청크를 저장한 뒤 중단된 것처럼 만든다
+    save_validation = kfood_validate.save_validation
+    def interrupted_save(results, path):
+        save_validation(results, path)
+        raise KeyboardInterrupt
+    monkeypatch.setattr(kfood_validate, 'save_validation', interrupted_save)
+    with pytest.raises(KeyboardInterrupt):
+        kfood_validate.validate_dataset(image_paths, crops, validation_path, n_workers=1, chunk_size=2)
+
+    saved = kfood_validate.load_validation(validation_path)
+    assert len(saved) == 2
+    assert all('status' in result for result in saved.values())
+
+    monkeypatch.setattr(kfood_validate, 'save_validation', save_validation)
+    quarantine = kfood_validate.validate_dataset(image_paths, crops, validation_path, n_workers=1, chunk_size=2)
+    assert list(quarantine) == [image_paths[-1]]
+
+    results = kfood_validate.load_validation(validation_path)
+    assert sorted(results) == sorted(image_paths)
+    assert [results[path]['status'] for path in image_paths] == ['ok'] * 4 + ['invalid']
+
+
+def test_entry_without_status_is_checked_again(image_paths, tmp_path):
+    validation_path = str(tmp_path / 'validation.json')
+    crops = [NO_CROP] * len(image_paths)
+    #이전 버전이 남긴 status 없는 항목
+    stat = os.stat(image_paths[0])
+    kfood_validate.save_validation({image_paths[0]: {'mtime': stat.st_mtime, 'size': stat.st_size, 'crop': NO_CROP}}, validation_path)
+
+    quarantine = kfood_validate.validate_dataset(image_paths, crops, validation_path, n_workers=1)
+    assert list(quarantine) == [image_paths[-1]]
+    assert kfood_validate.load_validation(validation_path)[image_paths[0]]['status'] == 'ok'
@@ -1,27 +1,368 @@
 from operator import mod
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import tensorflow as tf
 from tensorflow import keras
 import numpy as np
 from pathlib import Path
 import pickle
 import os
+import re
+import csv
+import time
+import json
+import shutil
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 class WeightsSaver(keras.callbacks.Callback):
-    def __init__(self, weights_save_path, epochs, **kwargs):
+    #에폭마다 가중치를 메모리에 복사해 두고, 파일 쓰기와 loss 그래프는 별도 스레드에서 한다
+    #keep_last : 최근 에폭 수, keep_best : monitor 가 가장 좋은 에폭 수, 나머지 스냅샷은 지운다
+    #mode : 'max', 'min', 'auto' (ModelCheckpoint 와 같이 acc 가 들어간 monitor 는 max, 나머지는 min)
+    def __init__(self, weights_save_path, epochs, keep_last=3, keep_best=2, monitor='val_accuracy', mode='auto', **kwargs):
+        super().__init__()
         self.epochs = epochs
-        self.weights_save_path = weights_save_path
-        self.loss = np.array([])
-    
+        self.weights_save_path = Path(weights_save_path)
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.monitor = monitor
+        if mode not in ('auto', 'max', 'min'):
+            raise ValueError('mode must be auto, max or min : {}'.format(mode))
+        if mode == 'auto':
+            mode = 'max' if 'acc' in monitor else 'min'
+        self.mode = mode
+        self.metrics = []
+        self.snapshots = {}
+        self.futures = []
+        #스레드 1 개 : 쓰기 순서가 에폭 순서와 같다
+        self.writer = ThreadPoolExecutor(1)
+
+    def resume(self, initial_epoch):
+        #이어서 훈련할 때 이전 metrics.csv 와 스냅샷을 다시 읽는다, initial_epoch 이후 기록은 다시 훈련하므로 버린다
+        metrics_path = self.weights_save_path / 'metrics.csv'
+        if metrics_path.exists():
+            with open(metrics_path, newline='') as f:
+                for row in csv.DictReader(f):
+                    row = {key: float(value) for key, value in row.items() if value != ''}
+                    row['epoch'] = int(row['epoch'])
+                    if row['epoch'] < initial_epoch:
+                        self.metrics.append(row)
+        monitored = {row['epoch']: row.get(self.monitor) for row in self.metrics}
+        for path in self.weights_save_path.glob('epoch:*.weights.npz'):
+            match = re.match(r'epoch:(\d+)_', path.name)
+            if match is None:
+                continue
+            epoch = int(match.group(1))
+            if epoch < initial_epoch:
+                self.snapshots[epoch] = (path, monitored.get(epoch))
+            else:
+                os.remove(path)
+        self.remove_snapshots()
+
     def on_epoch_end(self, epoch, logs={}):
+        weights = self.model.get_weights()
+        row = dict(logs, epoch=epoch)
+        self.futures.append(self.writer.submit(self.write_snapshot, epoch, weights, row))
+
+    def on_train_end(self, logs=None):
+        self.flush()
+
+    def flush(self):
+        #쓰기 스레드에서 난 에러는 여기서 다시 발생한다
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def write_snapshot(self, epoch, weights, row):
+        path = self.weights_save_path / "epoch:{}_acc:{:.2f}.weights.npz".format(epoch, row.get('val_accuracy', 0.))
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, *weights)
+        os.replace(tmp_path, path)
+        self.snapshots[epoch] = (path, row.get(self.monitor))
+        self.metrics.append(row)
+        self.remove_snapshots()
+        self.write_metrics()
+
+    def remove_snapshots(self):
+        epochs = sorted(self.snapshots)
+        keep = set(epochs[-self.keep_last:]) if self.keep_last else set()
+        scored = [epoch for epoch in epochs if self.snapshots[epoch][1] is not None]
+        keep.update(sorted(scored, key=lambda epoch: self.snapshots[epoch][1], reverse=self.mode == 'max')[:self.keep_best])
+        for epoch in epochs:
+            if epoch not in keep:
+                path, _ = self.snapshots.pop(epoch)
+                if path.exists():
+                    os.remove(path)
+
+    def write_metrics(self):
+        keys = sorted({key for row in self.metrics for key in row} - {'epoch'})
+        with open(self.weights_save_path / 'metrics.csv', 'w') as f:
+            f.write(','.join(['epoch'] + keys) + '\n')
+            for row in self.metrics:
+                f.write(','.join([str(row['epoch'])] + [str(row.get(key, '')) for key in keys]) + '\n')
+
+        #pyplot 은 스레드에 안전하지 않으므로 Figure 를 직접 만든다, 매번 새 Figure 라 메모리가 늘지 않는다
+        epochs = [row['epoch'] + 1 for row in self.metrics]
+        loss = [row['loss'] for row in self.metrics]
+        figure = Figure(figsize=(6, 4))
+        ax = figure.subplots()
+        ax.plot(epochs, loss, label='loss')
+        if all('val_loss' in row for row in self.metrics):
+            ax.plot(epochs, [row['val_loss'] for row in self.metrics], label='val_loss')
+        ax.axis([1, self.epochs, 0, loss[0] * 1.2])
+        ax.legend()
+        figure.savefig(self.weights_save_path / "loss.png", format="png", dpi=100)
+
+
+class StepProfiler(keras.callbacks.Callback):
+    #step 마다 wall time, 입력 대기 (데이터셋 iterator), 계산 시간, examples/sec, RSS 를 profile.jsonl 에 기록한다
+    #trace_steps : (시작, 끝) 전체 step 번호, 이 구간은 tf.profiler trace 를 profile_trace 에 남긴다
+    def __init__(self, log_path, trace_steps=None, trace_path=None):
+        super().__init__()
+        self.log_path = Path(log_path)
+        self.trace_steps = trace_steps
+        self.trace_path = str(trace_path or self.log_path.parent / 'profile_trace')
+        self.rows = []
+        self.epoch = 0
+        self.step = 0
+        self.tracing = False
+
+    def on_train_begin(self, logs=None):
+        #입력 대기를 따로 재기 위해 next(iterator) 를 tf.function 밖으로 꺼낸다
+        #분산 학습은 keras 의 train_function 을 그대로 쓰고 wall time 만 기록한다
+        self.original_train_function = self.model.train_function
+        self.timing = {}
+        if self.model.distribute_strategy.num_replicas_in_sync == 1 and not isinstance(self.original_train_function, ProfiledTrainFunction):
+            self.model.train_function = ProfiledTrainFunction(self.model, self.timing)
+        self.last_time = time.perf_counter()
+
+    def on_train_end(self, logs=None):
+        self.model.train_function = self.original_train_function
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+        self.flush()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.last_time = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.trace_steps and self.step == self.trace_steps[0] and not self.tracing:
+            tf.profiler.experimental.start(self.trace_path)
+            self.tracing = True
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        wall = now - self.last_time
+        self.last_time = now
+        batch_size = self.timing.get('batch_size')
+        self.rows.append({
+            'epoch': self.epoch,
+            'step': self.step,
+            'wall_ms': round(wall * 1000, 3),
+            'input_ms': round(self.timing['input'] * 1000, 3) if 'input' in self.timing else None,
+            'compute_ms': round(self.timing['compute'] * 1000, 3) if 'compute' in self.timing else None,
+            'examples_per_sec': round(batch_size / wall, 2) if batch_size else None,
+            'rss_mb': get_rss_mb(),
+        })
+        self.step += 1
+        if self.tracing and self.step >= self.trace_steps[1]:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.flush()
+
+    def flush(self):
+        with open(self.log_path, 'a') as f:
+            for row in self.rows:
+                f.write(json.dumps(row) + '\n')
+        self.rows = []
+
+
+class ProfiledTrainFunction:
+    #keras 의 train_function(iterator) 대신, 입력은 eager 로 꺼내고 train_step 만 tf.function 으로 실행한다
+    def __init__(self, model, timing):
+        self.model = model
+        self.timing = timing
+        self.step_function = tf.function(model.train_step, jit_compile=bool(getattr(model, 'jit_compile', False)))
+
+    def __call__(self, iterator):
+        start = time.perf_counter()
+        data = next(iterator)
+        ready = time.perf_counter()
+        logs = self.step_function(data)
+        #keras 의 train_function 처럼 step 수를 센다 (TensorBoard 등의 step)
+        if getattr(self.model, '_train_counter', None) is not None:
+            self.model._train_counter.assign_add(1)
+        #CPU 에서는 tf.function 호출이 계산이 끝나야 반환된다
+        self.timing.update({
+            'input': ready - start,
+            'compute': time.perf_counter() - ready,
+            'batch_size': int(tf.nest.flatten(data)[0].shape[0]),
+        })
+        return logs
+
+
+def get_rss_mb():
+    #/proc/self/statm 의 두번째 값 (resident pages)
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20, 1)
+    except (OSError, ValueError):
+        return None
+
+
+class TrainingStateSaver(keras.callbacks.Callback):
+    #모델, optimizer (slot, iterations, learning rate), 에폭, best 기록을 tf.train.Checkpoint 로 저장한다
+    #save_steps : 에폭 중간에도 저장, 이어서 훈련할 때는 그 에폭의 처음부터 다시 한다
+    #             가중치와 optimizer slot 은 중간 저장 시점의 값이라 그 에폭에서 이미 본 batch 를 다시 한번 학습한다
+    #             (데이터 순서와 RNG 는 저장하지 않는다, get_training_state 참고), iterations 는 에폭 시작 값으로 되돌린다
+    def __init__(self, state, manager, best_weights_saver=None, save_steps=None):
+        super().__init__()
+        self.state = state
+        self.manager = manager
+        self.best_weights_saver = best_weights_saver
+        self.save_steps = save_steps
+
+    def on_train_begin(self, logs=None):
+        if self.state.epoch_iterations.numpy() < 0:
+            self.state.epoch_iterations.assign(self.model.optimizer.iterations)
+
+    def on_train_batch_end(self, batch, logs=None):
+        if self.save_steps and (batch + 1) % self.save_steps == 0:
+            self.manager.save(checkpoint_number=self.model.optimizer.iterations)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.state.epoch.assign(epoch + 1)
+        self.state.epoch_iterations.assign(self.model.optimizer.iterations)
+        if self.best_weights_saver is not None:
+            self.state.best.assign(self.best_weights_saver.best)
+        self.manager.save(checkpoint_number=self.model.optimizer.iterations)
 
-        self.model.save_weights(self.weights_save_path / "epoch:{}_acc:{:.2f}.weights".format(epoch, logs['val_accuracy']))
-        self.loss = np.append(self.loss, logs["loss"])
-        plt.plot(np.arange(1, epoch+2), self.loss)
-        plt.axis([1, self.epochs, 0, self.loss[0] * 1.2])
-        plt.savefig(self.weights_save_path / "loss.png", format="png", dpi=300)
+
+def get_training_state(model):
+    #RNG 상태는 저장하지 않는다 : 데이터 파이프라인의 augmentation 은 전역 seed 의 stateful random op 를 쓰므로
+    #tf.random.Generator 를 저장해도 복원되지 않는다, 이어서 훈련하면 random crop 순서는 새로 정해진다
+    return tf.train.Checkpoint(
+        model=model,
+        optimizer=model.optimizer,
+        epoch=tf.Variable(0, dtype=tf.int64, trainable=False),
+        #epoch 이 시작할 때의 optimizer.iterations, 에폭 중간 저장에서 이어서 훈련할 때 되돌린다 (-1 : 없음)
+        epoch_iterations=tf.Variable(-1, dtype=tf.int64, trainable=False),
+        best=tf.Variable(-np.inf, dtype=tf.float64, trainable=False),
+    )
+
+
+def load_snapshot(model, snapshot_path):
+    #WeightsSaver 가 저장한 .weights.npz 를 model 에 불러온다
+    with np.load(snapshot_path) as f:
+        model.set_weights([f['arr_{}'.format(i)] for i in range(len(f.files))])
+    return model
         
     
         
+class GradientAccumulator:
+    #keras 가 추적하지 않도록 일반 객체에 담는다 (모델 가중치 목록, save_weights 형식이 그대로 유지된다)
+    def __init__(self, variables):
+        synchronization = tf.VariableSynchronization.ON_READ
+        self.gradients = [
+            tf.Variable(tf.zeros_like(variable), trainable=False, synchronization=synchronization, aggregation=tf.VariableAggregation.SUM)
+            for variable in variables
+        ]
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False, synchronization=synchronization, aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+
+
+class GradientAccumulationModel(keras.Model):
+    #accumulation_steps 개의 micro batch 기울기를 더한 뒤 optimizer 를 한번 적용한다
+    #optimizer.iterations 는 optimizer step 만 센다
+    def __init__(self, inputs, outputs, accumulation_steps, **kwargs):
+        super().__init__(inputs=inputs, outputs=outputs, **kwargs)
+        self.accumulation_steps = accumulation_steps
+        self.accumulator = GradientAccumulator(self.trainable_variables)
+        #BatchNorm 이동 평균은 micro batch 마다 갱신되므로 optimizer step 당 감쇠가 momentum 이 되도록 맞춘다
+        for layer in self._flatten_layers():
+            if isinstance(layer, keras.layers.BatchNormalization):
+                layer.momentum = layer.momentum ** (1. / accumulation_steps)
+
+    def train_step(self, data):
+        x, y, sample_weight = keras.utils.unpack_x_y_sample_weight(data)
+        loss_scale = isinstance(self.optimizer, keras.mixed_precision.LossScaleOptimizer)
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+            scaled_loss = loss / self.accumulation_steps
+            if loss_scale:
+                scaled_loss = self.optimizer.get_scaled_loss(scaled_loss)
+        gradients = tape.gradient(scaled_loss, self.trainable_variables)
+        if loss_scale:
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        for accumulated, gradient in zip(self.accumulator.gradients, gradients):
+            accumulated.assign_add(gradient)
+        self.accumulator.step.assign_add(1)
+        tf.cond(self.accumulator.step % self.accumulation_steps == 0, self.apply_accumulated, lambda: None)
+
+        self.compiled_metrics.update_state(y, y_pred, sample_weight)
+        return {metric.name: metric.result() for metric in self.metrics}
+
+    def apply_accumulated(self):
+        self.optimizer.apply_gradients(zip([accumulated.value() for accumulated in self.accumulator.gradients], self.trainable_variables))
+        for accumulated in self.accumulator.gradients:
+            accumulated.assign(tf.zeros_like(accumulated))
+
+
+def get_distillation_loss(n_classes=150, temperature=4., alpha=0.9):
+    #y_true : [one-hot, teacher logits] (make_kfood_dataset(teacher_logits=...)), one-hot 만 있으면 (검증 세트) 일반 crossentropy
+    #soft loss 는 temperature^2 를 곱해 hard loss 와 기울기 크기를 맞춘다
+    def distillation_loss(y_true, y_pred):
+        y_true = tf.cast(y_true, tf.float32)
+        hard_loss = keras.losses.categorical_crossentropy(y_true[:, :n_classes], y_pred)
+        if y_true.shape[-1] == n_classes:
+            return hard_loss
+        teacher_targets = tf.nn.softmax(y_true[:, n_classes:] / temperature)
+        student_log_probs = tf.nn.log_softmax(tf.math.log(y_pred + 1e-7) / temperature)
+        soft_loss = -tf.reduce_sum(teacher_targets * student_log_probs, axis=-1) * temperature ** 2
+        return alpha * soft_loss + (1. - alpha) * hard_loss
+    return distillation_loss
+
+
+def get_distillation_accuracy(n_classes=150):
+    #history 의 키가 accuracy, val_accuracy 로 남도록 이름을 맞춘다
+    def accuracy(y_true, y_pred):
+        return keras.metrics.categorical_accuracy(y_true[:, :n_classes], y_pred)
+    return accuracy
+
+
+def build_model(model_name, input_shape=[299, 299, 3], precision='float32'):
+    #mixed precision 정책은 모델을 만드는 동안만 적용한다, 마지막 Dense(softmax) 는 float32
+    policy = keras.mixed_precision.global_policy()
+    keras.mixed_precision.set_global_policy(precision)
+    try:
+        if model_name=='KerasInceptionResNetV2':
+            from application.keras_inception_resnet_v2 import KerasInceptionResNetV2
+            model = KerasInceptionResNetV2(input_shape=input_shape)
+        elif model_name=='KerasInceptionResNetV2SEBlock':
+            from application.keras_inception_resnet_v2_se import KerasInceptionResNetV2SEBlock
+            model = KerasInceptionResNetV2SEBlock(input_shape=input_shape)
+        elif model_name=='InceptionResNetV2':
+            from application.inception_resnet_v2 import InceptionResNetV2
+            model = InceptionResNetV2(input_shape=input_shape)
+        elif model_name=='SmallKerasInceptionResNetV2':
+            from application.small_keras_inception_resnet_v2 import SmallKerasInceptionResNetV2
+            model = SmallKerasInceptionResNetV2(input_shape=input_shape)
+        elif model_name=='TinyKerasInceptionResNetV2':
+            from application.tiny_keras_inception_resnet_v2 import TinyKerasInceptionResNetV2
+            model = TinyKerasInceptionResNetV2(input_shape=input_shape)
+        elif model_name=='MicroKerasInceptionResNetV2':
+            from application.tiny_keras_inception_resnet_v2 import MicroKerasInceptionResNetV2
+            model = MicroKerasInceptionResNetV2(input_shape=input_shape)
+    finally:
+        keras.mixed_precision.set_global_policy(policy)
+    return model
+
+
 def train(
     train_set,
     valid_set,
@@ -47,20 +388,43 @@ def train(
     },
     lr_schedule=True,
     model_name='KerasInceptionResNetV2',
+    sparse_labels=False,
+    strategy=None,
+    save_training_state=True,
+    state_save_steps=None,
+    profile=False,
+    profile_trace_steps=None,
     ):
 
-    if model_name=='KerasInceptionResNetV2':
-        from application.keras_inception_resnet_v2 import KerasInceptionResNetV2
-        model = KerasInceptionResNetV2()
-    elif model_name=='KerasInceptionResNetV2SEBlock':
-        from application.keras_inception_resnet_v2_se import KerasInceptionResNetV2SEBlock
-        model = KerasInceptionResNetV2SEBlock()
-    elif model_name=='InceptionResNetV2':
-        from application.inception_resnet_v2 import InceptionResNetV2
-        model = InceptionResNetV2()
-    elif model_name=='SmallKerasInceptionResNetV2':
-        from application.small_keras_inception_resnet_v2 import SmallKerasInceptionResNetV2
-        model = SmallKerasInceptionResNetV2()
+    #image_size_schedule : [(시작 epoch, 이미지 크기), ...] 점점 큰 이미지로 훈련한다
+    #이 때 train_set (valid_set) 은 이미지 크기를 받아 데이터셋을 만드는 함수
+    #ex) lambda size: make_kfood_dataset(train_paths, image_size=(size, size))
+    image_size_schedule = train_property.get('image_size_schedule')
+    #GlobalAveragePooling 으로 끝나므로 입력 크기를 정하지 않으면 모든 단계에서 같은 가중치를 쓴다
+    input_shape = [None, None, 3] if image_size_schedule else [299, 299, 3]
+
+    #precision : 'float32', 'mixed_bfloat16', 'mixed_float16' (keras mixed precision policy)
+    precision = train_property.get('precision', 'float32')
+    #strategy : kfood_distributed 의 MultiWorkerMirroredStrategy, 모델과 optimizer 는 scope 안에서 만든다
+    scope = strategy.scope() if strategy is not None else contextlib.nullcontext()
+    n_replicas = strategy.num_replicas_in_sync if strategy is not None else 1
+    #accumulation_steps : micro batch (train_property['batch']) K 개를 모아 optimizer 를 한번 적용, 실제 batch = batch * K
+    accumulation_steps = train_property.get('accumulation_steps', 1)
+    jit_compile = train_property.get('jit_compile', False)
+    #distill : {'temperature': 4., 'alpha': 0.9}, train_set 은 make_kfood_dataset(teacher_logits=kfood_teacher.get_teacher_logits(...))
+    distill = train_property.get('distill')
+    if distill and sparse_labels:
+        raise ValueError('distill needs one-hot labels')
+    #apply_gradients 가 tf.cond 안에 있어서 strategy 의 merge_call 을 조건 분기 안에서 부를 수 없다
+    if accumulation_steps > 1 and strategy is not None:
+        raise ValueError('accumulation_steps can not be used with strategy')
+    with scope:
+        model = build_model(model_name, input_shape, precision)
+        if accumulation_steps > 1:
+            model = GradientAccumulationModel(model.inputs, model.outputs, accumulation_steps, name=model.name)
+    if accumulation_steps > 1:
+        #에폭 경계와 optimizer step 경계를 맞춘다 (에폭 끝의 상태 저장, learning rate 감쇠가 누적 중간에 걸리지 않게)
+        steps_per_epoch = max(steps_per_epoch // accumulation_steps, 1) * accumulation_steps
 
     train_property_name = train_property['optimizer']['name']
     train_property_name += '_lr:' + str(train_property['optimizer']['kwargs']['learning_rate'])
@@ -68,16 +432,36 @@ def train(
         train_property_name += '_decay:' + str(train_property['optimizer']['lr_decay'])
     train_property_name += '_batch:' + train_property['batch']
     train_property_name += '_crop:' + train_property['crop']
+    if precision != 'float32':
+        train_property_name += '_precision:' + precision
+    if image_size_schedule:
+        train_property_name += '_resize:' + '-'.join(str(image_size) for _, image_size in image_size_schedule)
+    if accumulation_steps > 1:
+        train_property_name += '_accum:' + str(accumulation_steps)
+    if jit_compile:
+        train_property_name += '_xla'
+    if distill:
+        train_property_name += '_distill:{}-{}'.format(distill.get('temperature', 4.), distill.get('alpha', 0.9))
+    if n_replicas > 1:
+        train_property_name += '_workers:' + str(n_replicas)
     
     
     weights_save_path = weights_save_path / model_name / train_property_name
+    pretrained_path = weights_save_path
+    temp_dir = None
+    if not is_chief(strategy):
+        #모든 worker 가 저장에 참여해야 하므로 chief 가 아닌 worker 는 임시 디렉토리에 저장하고, 훈련이 끝나면 지운다
+        #에폭별 스냅샷 (WeightsSaver) 은 chief 만 남긴다
+        temp_dir = tempfile.mkdtemp()
+        weights_save_path = Path(temp_dir)
+        save_weights_per_epoch = False
     
     os.makedirs(weights_save_path, exist_ok=True)
     with open(weights_save_path / "train_property.pkl", "wb") as f:
         pickle.dump(train_property, f)
 
     if pretrained:
-        model.load_weights(weights_save_path / 'best.weights')
+        model.load_weights(pretrained_path / 'best.weights')
 
     callbacks = []
     if save_best_weights:
@@ -94,26 +478,134 @@ def train(
         weights_saver = WeightsSaver(weights_save_path=weights_save_path, epochs=epochs)
         callbacks.append(weights_saver)
     
+    #strategy 가 있으면 데이터셋 batch (train_property['batch']) 는 global batch 이고 replica 마다 batch / n_replicas 를 받는다
+    #learning_rate 는 replica 하나의 batch 기준이므로 global batch 에 맞춰 n_replicas 배로 키운다
+    optimizer_kwargs = dict(train_property['optimizer']['kwargs'])
+    optimizer_kwargs['learning_rate'] = optimizer_kwargs['learning_rate'] * n_replicas
+
     if lr_schedule:
+        #홀수 에폭마다 lr_decay 를 곱한다, 현재 learning rate 대신 에폭으로 계산해서
+        #에폭 중간 저장 (이미 그 에폭의 감쇠가 적용된 learning rate) 에서 이어서 훈련해도 두번 곱하지 않는다
         lr_decay = train_property['optimizer']['lr_decay']
+        initial_lr = optimizer_kwargs['learning_rate']
         callbacks.append(keras.callbacks.LearningRateScheduler(
-            lambda epoch, lr: lr * lr_decay if epoch % 2 == 1 else lr
+            lambda epoch, lr: initial_lr * lr_decay ** ((epoch + 1) // 2)
         ))
+    with scope:
+        if train_property['optimizer']['name'] == 'SGD':
+            optimizer = keras.optimizers.SGD(**optimizer_kwargs)
+        elif train_property['optimizer']['name'] == 'RMSprop':
+            optimizer = keras.optimizers.RMSprop(**optimizer_kwargs)
+        elif train_property['optimizer']['name'] == 'Adam':
+            optimizer = keras.optimizers.Adam(**optimizer_kwargs)
+        #float16 은 loss scaling 이 필요하다, bfloat16 은 float32 와 지수 범위가 같아서 필요없다
+        if precision == 'mixed_float16':
+            optimizer = keras.mixed_precision.LossScaleOptimizer(optimizer)
 
-    if train_property['optimizer']['name'] == 'SGD':
-        optimizer = keras.optimizers.SGD(**train_property['optimizer']['kwargs'])
-    elif train_property['optimizer']['name'] == 'RMSprop':
-        optimizer = keras.optimizers.RMSprop(**train_property['optimizer']['kwargs'])
-    elif train_property['optimizer']['name'] == 'Adam':
-        optimizer = keras.optimizers.Adam(**train_property['optimizer']['kwargs'])
 
+        #make_kfood_dataset(sparse_labels=True) 의 정수 레이블
+        loss = 'sparse_categorical_crossentropy' if sparse_labels else 'categorical_crossentropy'
+        metrics = ['accuracy']
+        if distill:
+            n_classes = model.output_shape[-1]
+            loss = get_distillation_loss(n_classes, distill.get('temperature', 4.), distill.get('alpha', 0.9))
+            metrics = [get_distillation_accuracy(n_classes)]
+        #jit_compile : XLA 로 train step 을 컴파일한다 (conv2d_bn 의 Conv2D, BatchNormalization, Activation 을 하나로 합친다)
+        model.compile(loss=loss, optimizer=optimizer, metrics=metrics, jit_compile=jit_compile)
 
-    model.compile(loss='categorical_crossentropy', optimizer=optimizer, metrics=['accuracy'])
+    #profile : weights_save_path/profile.jsonl 에 step 별 시간 기록, profile_trace_steps=(10, 20) 이면 tf.profiler trace 도 남긴다
+    #입력 대기를 재기 위해 keras 의 train_function 을 바꾸므로 (steps_per_execution 무시, step 마다 eager 오버헤드) 필요할 때만 켠다
+    if profile:
+        callbacks.append(StepProfiler(weights_save_path / 'profile.jsonl', profile_trace_steps))
 
-    history = model.fit(train_set, steps_per_epoch=steps_per_epoch,
-            validation_data=valid_set, validation_steps=validation_steps,
-            epochs=epochs,
-            callbacks=callbacks,
-    )
+    #weights_save_path/state 에 마지막 훈련 상태가 있으면 그 에폭부터 이어서 훈련한다
+    #state_save_steps : 에폭 중간에도 저장한다, 이어서 훈련하면 그 에폭을 처음부터 다시 한다
+    #                   (중간 저장 시점의 가중치로 이미 본 batch 를 다시 학습, 데이터 순서와 RNG 는 복원하지 않는다)
+    initial_epoch = 0
+    if save_training_state:
+        with scope:
+            state = get_training_state(model)
+        manager = tf.train.CheckpointManager(state, weights_save_path / 'state', max_to_keep=2)
+        latest = tf.train.latest_checkpoint(pretrained_path / 'state')
+        if latest:
+            #optimizer slot 은 첫 step 에서 만들어질 때 복원된다
+            state.restore(latest)
+            initial_epoch = int(state.epoch.numpy())
+            #에폭 중간 저장이면 다시 하는 step 을 두번 세지 않도록 에폭 시작의 iterations 로 되돌린다
+            if state.epoch_iterations.numpy() >= 0:
+                model.optimizer.iterations.assign(state.epoch_iterations)
+            if save_best_weights and np.isfinite(state.best.numpy()):
+                best_weights_saver.best = float(state.best.numpy())
+            print('resume from {} (epoch {}, step {})'.format(latest, initial_epoch, int(model.optimizer.iterations.numpy())))
+        if strategy is not None:
+            check_resume_epoch(strategy, initial_epoch)
+        callbacks.append(TrainingStateSaver(state, manager, best_weights_saver if save_best_weights else None, state_save_steps))
+    if save_weights_per_epoch:
+        weights_saver.resume(initial_epoch)
+
+    try:
+        if image_size_schedule:
+            history = None
+            for phase_start, phase_epochs, image_size in get_resize_phases(image_size_schedule, epochs):
+                if phase_epochs <= initial_epoch:
+                    continue
+                phase_start = max(phase_start, initial_epoch)
+                print('image size : {} (epoch {} ~ {})'.format(image_size, phase_start + 1, phase_epochs))
+                phase_history = model.fit(train_set(image_size), steps_per_epoch=steps_per_epoch,
+                        validation_data=valid_set(image_size) if callable(valid_set) else valid_set, validation_steps=validation_steps,
+                        initial_epoch=phase_start,
+                        epochs=phase_epochs,
+                        callbacks=callbacks,
+                )
+                if history is None:
+                    history = phase_history
+                else:
+                    for key, values in phase_history.history.items():
+                        history.history.setdefault(key, []).extend(values)
+                    history.epoch.extend(phase_history.epoch)
+        else:
+            history = model.fit(train_set, steps_per_epoch=steps_per_epoch,
+                    validation_data=valid_set, validation_steps=validation_steps,
+                    initial_epoch=initial_epoch,
+                    epochs=epochs,
+                    callbacks=callbacks,
+            )
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
     return model, history
+
+
+def check_resume_epoch(strategy, initial_epoch):
+    #모든 worker 가 같은 에폭에서 시작해야 collective 가 멈추지 않는다
+    #여러 호스트에서는 weights_save_path 가 공유 파일시스템이어야 모든 worker 가 같은 state 를 읽는다
+    epoch = tf.constant(initial_epoch, dtype=tf.float64)
+    per_replica = strategy.run(lambda: tf.stack([epoch, epoch ** 2, 1.]))
+    total, squared, n_replicas = strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica, axis=None).numpy()
+    #분산이 0 이면 모든 worker 의 에폭이 같다, 모든 worker 가 같은 결과를 보므로 같이 멈춘다
+    if abs(n_replicas * squared - total ** 2) > 0.5:
+        raise RuntimeError('workers resume from different epochs (mean {:.1f}), '
+                           'weights_save_path must be on a filesystem shared by all hosts'.format(total / n_replicas))
+
+
+def is_chief(strategy):
+    #strategy 가 없거나 worker 0 (chief 가 따로 없는 클러스터) 이면 True
+    if strategy is None or getattr(strategy, 'cluster_resolver', None) is None:
+        return True
+    task_type, task_id = strategy.cluster_resolver.task_type, strategy.cluster_resolver.task_id
+    return task_type in (None, 'chief') or (task_type == 'worker' and task_id == 0)
+
+
+def get_resize_phases(image_size_schedule, epochs):
+    #[(0, 192), (50, 256), (100, 299)], 150 -> [(0, 50, 192), (50, 100, 256), (100, 150, 299)]
+    schedule = sorted(image_size_schedule)
+    if not schedule or schedule[0][0] != 0:
+        raise ValueError('image_size_schedule must start at epoch 0 : {}'.format(image_size_schedule))
+    phases = []
+    for i, (start, image_size) in enumerate(schedule):
+        end = schedule[i + 1][0] if i + 1 < len(schedule) else epochs
+        end = min(end, epochs)
+        if start < end:
+            phases.append((start, end, image_size))
+    return phases
         